@@ -0,0 +1,142 @@
+import cache
+from tools import RunTable
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Asset:
+    def __init__(self, key):
+        self.key = key
+        self.refs = 0
+
+        self._image = None
+        self._mask = None
+        self._runs = None
+
+        self.future = None
+
+    def wait(self):
+        if self.future is not None:
+            self.future.result()  # Finish a background preload instead of loading twice
+            self.future = None
+
+    def load_image(self):
+        if self._image is None:
+            path, size, flip, _ = self.key
+            self._image = cache.load_image(path, size, flip, rle=True)  # Resident and blitted every frame they are on screen
+
+        return self._image
+
+    def load_mask(self):
+        if self._mask is None:
+            self._mask = cache.load_mask(*self.key)
+
+        return self._mask
+
+    def load_runs(self):
+        if self._runs is None:
+            self._runs = RunTable(self.load_mask())
+
+        return self._runs
+
+    def preload(self, image, mask, runs):
+        if image:
+            self.load_image()
+
+        if mask:
+            self.load_mask()
+
+        if runs:
+            self.load_runs()
+
+    @property
+    def image(self):
+        self.wait()
+        return self.load_image()
+
+    @property
+    def mask(self):
+        self.wait()
+        return self.load_mask()
+
+    @property
+    def runs(self):
+        self.wait()
+        return self.load_runs()
+
+
+class Registry:
+    def __init__(self, capacity=32):
+        self.capacity = capacity  # Unreferenced assets kept around for the next acquire
+
+        self.live = {}
+        self.idle = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.executor = None
+
+    def acquire(self, path, size=None, flip=False, colorkey=None):
+        key = (path, size, flip, colorkey)
+
+        if key in self.live:
+            asset = self.live[key]
+            self.hits += 1
+
+        elif key in self.idle:
+            asset = self.live[key] = self.idle.pop(key)
+            self.hits += 1
+
+        else:
+            asset = self.live[key] = Asset(key)
+            self.misses += 1
+
+        asset.refs += 1
+        return asset
+
+    def release(self, asset):
+        asset.refs -= 1
+
+        if asset.refs > 0:
+            return
+
+        del self.live[asset.key]
+        self.idle[asset.key] = asset
+
+        while len(self.idle) > self.capacity:
+            self.idle.popitem(last=False)
+            self.evictions += 1
+
+    def prefetch(self, path, size=None, flip=False, colorkey=None, image=True, mask=True, runs=False):
+        key = (path, size, flip, colorkey)
+
+        if key in self.live or key in self.idle:
+            return
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+
+        asset = self.idle[key] = Asset(key)  # Parked as idle so the next acquire is a hit
+        asset.future = self.executor.submit(asset.preload, image, mask, runs)
+
+        while len(self.idle) > self.capacity:
+            self.idle.popitem(last=False)
+            self.evictions += 1
+
+    def trim(self):
+        self.evictions += len(self.idle)  # Nothing holds these, the next acquire loads them again
+        self.idle.clear()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "live": len(self.live),
+            "idle": len(self.idle)
+        }
+
+
+registry = Registry()
@@ -0,0 +1,337 @@
+import os
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")  # Runs on boxes without a display
+
+import argparse
+import random
+import subprocess
+import sys
+import time
+import numpy as np
+import pygame
+import cache
+import main
+import states
+from collections import defaultdict
+from entities import GhostSwarm
+from profiler import profiler
+from levels import pack
+from replay import HeldKeys
+
+
+SCRIPT_KEYS = {
+    "L": pygame.K_LEFT,
+    "R": pygame.K_RIGHT,
+    "U": pygame.K_UP,
+    "D": pygame.K_DOWN,
+    "E": pygame.K_ESCAPE
+}
+
+DEFAULT_SCRIPT = "R0-400 U20 U140 D180 L400-700 U420 D460 U600 R700-1000 U720 U850"
+
+# Runs in a fresh interpreter so imports aren't already cached, prints milliseconds since its first line
+STARTUP_PROBE = """
+import time
+start = time.perf_counter()
+
+import main
+
+imported = time.perf_counter()
+
+control = main.Control("menu")
+control.draw(1)
+control.present()
+first_frame = time.perf_counter()
+
+control.state.next = "tower"  # Start clicked on the very first frame, before any warmup step ran
+control.state.done = True
+control.update(control.step)
+control.draw(1)
+control.present()
+playable = time.perf_counter()
+
+print(*[(t - start) * 1000 for t in (imported, first_frame, playable)])
+"""
+
+STARTUP_PHASES = ["import", "first frame", "first playable frame"]
+
+
+def blit_assets(screen):
+    # (name, as every image used to load, whether its loader asks for RLE, the screens that draw it each frame)
+    level = pack.ids[0]
+    art = pygame.image.frombuffer(pack.blob(level, "art"), tuple(pack.levels[level]["size"]), "RGBA").convert_alpha()
+
+    return [
+        ("level art", art, False, ["level"]),
+        ("player frame", cache.decode("sprites/player/dino_walking_2.png", (45, 51)), False, ["level"]),
+        ("ghost frame", cache.decode("sprites/ghosts/ghost_orange_left.png", (40, 40)), False, ["level"]),
+        ("confetti frame", cache.decode("sprites/win/win_main_12.png", (1080, 1920), clip=screen.get_size()), False, ["victory"]),
+        ("victory title", cache.decode("sprites/victory.png"), True, ["victory"]),
+        ("button", cache.decode("sprites/restart_button.png"), True, ["victory"] * 3)
+    ]
+
+
+def describe(surface):
+    rle = "+RLE" if surface.get_flags() & (pygame.RLEACCEL | pygame.RLEACCELOK) else ""
+
+    if surface.get_flags() & pygame.SRCALPHA:
+        return "alpha" + rle
+
+    if surface.get_colorkey() is None:
+        return "opaque"
+
+    return "colorkey" + rle
+
+
+def time_blits(screen, surface, count):
+    samples = []
+
+    for _ in range(count):
+        start = time.perf_counter()
+        screen.blit(surface, (0, 0))
+        samples.append(time.perf_counter() - start)
+
+    return samples
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * p / 100), len(samples) - 1)]
+
+
+def report(name, samples):
+    print(f"{name:<28} p50 {percentile(samples, 50) * 1000:8.3f} ms  p99 {percentile(samples, 99) * 1000:8.3f} ms")
+
+
+class Script:
+    # Tokens like "R0-400" hold a key over a frame range, "U20" presses it once on a frame
+    def __init__(self, text):
+        self.holds = []
+        self.presses = defaultdict(list)
+
+        for token in text.split():
+            key = SCRIPT_KEYS[token[0].upper()]
+
+            if "-" in token:
+                start, end = token[1:].split("-")
+                self.holds.append((key, int(start), int(end)))
+            else:
+                self.presses[int(token[1:])].append(key)
+
+    def events(self, frame):
+        return [pygame.event.Event(pygame.KEYDOWN, key=key) for key in self.presses.get(frame, ())]
+
+    def keys(self, frame):
+        return HeldKeys({key for key, start, end in self.holds if start <= frame < end})
+
+
+def spawn_ghosts(level, count, seed, kind="direct"):
+    rng = random.Random(seed)
+    w, h = level.stage.image.get_size()
+
+    level.ghosts.destroy()
+    level.ghosts = GhostSwarm([(rng.randint(0, w - 40), rng.randint(0, h - 40), "orange", kind) for _ in range(count)])
+
+
+def bench_ghosts(args):
+    screen = main.bootstrap()
+
+    for count in args.counts:
+        level = states.Level(pack.ids[0])
+        level.startup(screen)
+        spawn_ghosts(level, count, count, "pathing" if args.pathing else "direct")
+
+        field = level.stage.field if args.pathing else None
+        flood, update, collide, draw = [], [], [], []
+
+        for frame in range(args.frames):
+            if args.pathing:
+                level.player.get_keys(HeldKeys({pygame.K_LEFT if frame // 120 % 2 else pygame.K_RIGHT}))  # Keep crossing cells so the field floods again
+
+            level.player.update(level.stage, 1 / main.TICK_RATE)
+
+            if field is not None:
+                start = time.perf_counter()
+                field.aim(level.player.rect.topleft)  # Timed on its own, the swarm's own aim() below is then a no-op
+                flood.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            level.ghosts.update(level.player, 1 / main.TICK_RATE, field)
+            update.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            level.ghosts.check_collision(level.player)
+            collide.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            level.ghosts.draw(screen, 1)
+            draw.append(time.perf_counter() - start)
+
+        print(f"{count} ghosts")
+
+        if flood:
+            report("  flow field", flood)
+
+        report("  swarm update", update)
+        report("  swarm collide", collide)
+        report("  swarm draw", draw)
+
+        level.destroy()
+
+
+def bench_blits(args):
+    screen = main.bootstrap()
+    totals = defaultdict(lambda: [0, 0])
+
+    for name, image, rle, screens in blit_assets(screen):
+        optimized = cache.optimize(image.copy(), rle)  # What the loaders now hand out, partly transparent images are changed in place
+
+        time_blits(screen, optimized, 10)  # RLE surfaces are encoded on their first blit
+        before = time_blits(screen, image, args.blits)
+        after = time_blits(screen, optimized, args.blits)
+
+        print(f"{name} ({image.get_width()}x{image.get_height()}, {describe(optimized)})")
+        report("  per-pixel alpha", before)
+        report(f"  {describe(optimized)}", after)
+
+        for screen_name in screens:
+            totals[screen_name][0] += percentile(before, 50)
+            totals[screen_name][1] += percentile(after, 50)
+
+    for screen_name, (before, after) in totals.items():
+        print(f"{screen_name} screen blits per frame: {before * 1000:.3f} ms -> {after * 1000:.3f} ms, {(before - after) * 1000:.3f} ms saved")
+
+
+def bench_frames(args):
+    script = Script(args.script)
+    control = main.Control(args.state)
+    control.accumulator = control.step
+
+    profiler.enabled = True
+    profiler.records.clear()
+
+    for frame in range(args.frames):
+        if not control.running or (args.stop_on_flip and control.state.id != args.state):
+            break
+
+        profiler.begin_frame()
+
+        control.handle_input(script.events(frame), script.keys(frame))
+        control.simulate()
+        control.draw(control.accumulator / control.step)
+        control.present()
+
+        control.accumulator += args.dt
+        profiler.end_frame(control.state.id)
+
+    if args.profile:
+        profiler.export(args.profile)
+
+    frames = profiler.samples("frame_ms")
+    print(f"{len(frames)} frames from {args.state}, ended in {control.state.id}")
+
+    for name in ["event_loop", "update", "Player.update", "GhostSwarm.update", "draw", "display update", "frame_ms"]:
+        report(f"  {name}", [ms / 1000 for ms in profiler.samples(name)])
+
+    worst = percentile(frames, 99)
+
+    if args.max_p99 is not None and worst > args.max_p99:
+        print(f"p99 frame time {worst:.3f} ms exceeds budget of {args.max_p99} ms")
+        sys.exit(1)
+
+
+def bench_startup(args):
+    samples = defaultdict(list)
+    env = dict(os.environ, PYGAME_HIDE_SUPPORT_PROMPT="1")
+
+    for _ in range(args.runs):
+        result = subprocess.run([sys.executable, "-c", STARTUP_PROBE], env=env, capture_output=True, text=True, check=True)
+
+        for name, ms in zip(STARTUP_PHASES, result.stdout.split()[-3:]):
+            samples[name].append(float(ms) / 1000)
+
+    print(f"{args.runs} cold starts")
+
+    budgets = dict(zip(STARTUP_PHASES, [args.max_import, args.max_first_frame, args.max_playable]))
+    over = []
+
+    for name in STARTUP_PHASES:
+        report(f"  {name}", samples[name])
+
+        median = percentile(samples[name], 50) * 1000
+
+        if median > budgets[name]:
+            over.append(f"{name} p50 {median:.1f} ms exceeds budget of {budgets[name]} ms")
+
+    for line in over:
+        print(line)
+
+    if over:
+        sys.exit(1)
+
+
+def bench_env(args):
+    import env
+
+    rng = np.random.default_rng(0)
+
+    if args.workers:
+        envs = env.ProcessVectorEnv(args.workers, args.envs, frame_skip=args.frame_skip)
+    else:
+        envs = env.VectorEnv(args.envs, frame_skip=args.frame_skip)
+
+    envs.reset()
+    start = time.perf_counter()
+
+    for _ in range(args.steps):
+        envs.step(rng.integers(0, env.NUM_ACTIONS, len(envs)))
+
+    elapsed = time.perf_counter() - start
+    frames = args.steps * len(envs) * args.frame_skip
+
+    print(f"{len(envs)} envs, {frames} simulated frames in {elapsed:.2f} s")
+    print(f"  {frames / elapsed * 60 / 1e6:.2f} M frames/minute")
+
+    envs.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    ghosts = commands.add_parser("ghosts", help="ghost swarm cost as the ghost count grows")
+    ghosts.add_argument("--counts", type=int, nargs="+", default=[1, 10, 100, 1000, 5000])
+    ghosts.add_argument("--frames", type=int, default=240)
+    ghosts.add_argument("--pathing", action="store_true", help="ghosts follow the level's shared flow field around walls")
+    ghosts.set_defaults(func=bench_ghosts)
+
+    blits = commands.add_parser("blits", help="blit cost of the real assets as per-pixel alpha and as the format they now load in")
+    blits.add_argument("--blits", type=int, default=500)
+    blits.set_defaults(func=bench_blits)
+
+    frames = commands.add_parser("frames", help="step Control headless with scripted input and time each phase")
+    frames.add_argument("--state", default=pack.ids[0], choices=sorted(main.state_dict))
+    frames.add_argument("--frames", type=int, default=1200)
+    frames.add_argument("--dt", type=float, default=1 / main.TICK_RATE, help="simulated seconds per frame")
+    frames.add_argument("--script", default=DEFAULT_SCRIPT, help="e.g. 'R0-400 U20', a range holds a key, a frame presses it")
+    frames.add_argument("--stop-on-flip", action="store_true", help="stop once the start state is left")
+    frames.add_argument("--max-p99", type=float, help="exit non-zero if the p99 frame time exceeds this many ms")
+    frames.add_argument("--profile", metavar="PATH", help="also write every frame's scopes and counters as .jsonl or .csv")
+    frames.set_defaults(func=bench_frames)
+
+    startup = commands.add_parser("startup", help="time to import, first menu frame and first playable frame in fresh processes")
+    startup.add_argument("--runs", type=int, default=5)
+    startup.add_argument("--max-import", type=float, default=400, help="budget in ms for the median run")
+    startup.add_argument("--max-first-frame", type=float, default=450)
+    startup.add_argument("--max-playable", type=float, default=550)
+    startup.set_defaults(func=bench_startup)
+
+    environment = commands.add_parser("env", help="simulated frames per minute through the batched environment API")
+    environment.add_argument("--envs", type=int, default=64, help="instances per process")
+    environment.add_argument("--workers", type=int, default=0, help="worker processes, 0 runs in this process")
+    environment.add_argument("--steps", type=int, default=200)
+    environment.add_argument("--frame-skip", type=int, default=4)
+    environment.set_defaults(func=bench_env)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,183 @@
+import pygame
+import glob
+import hashlib
+import math
+import os
+import struct
+import zlib
+
+
+CACHE_DIR = ".cache"
+VERSION = 1
+MAX_ENTRY_BYTES = 1024 * 1024  # Screen-sized upscaled frames load slower from disk than from their small PNG
+
+HEADER = struct.Struct("<4sHH")  # Magic, width, height
+
+COLORKEYS = [(255, 0, 255), (0, 255, 255), (1, 2, 3), (254, 1, 253)]  # Tried in order until one isn't used by the art
+
+
+def cache_path(kind, path, size, flip, colorkey, clip=None):
+    stat = os.stat(path)
+    variant = f"{kind}|{os.path.abspath(path)}|{size}|{flip}|{colorkey}|{clip}"
+    stamp = f"{VERSION}|{stat.st_mtime_ns}|{stat.st_size}"
+
+    # Every build of one variant shares the prefix, so writing a new one finds the ones it replaces
+    name = hashlib.sha1(variant.encode()).hexdigest() + "-" + hashlib.sha1(stamp.encode()).hexdigest()[:16]
+
+    return os.path.join(CACHE_DIR, f"{name}.{kind}")
+
+
+def prune(file):
+    # Entries of the same variant from an older source file or cache version
+    prefix, kind = os.path.basename(file).split("-")[0], os.path.splitext(file)[1]
+
+    for stale in glob.glob(os.path.join(CACHE_DIR, f"{prefix}-*{kind}")):
+        if stale != file:
+            os.remove(stale)
+
+
+def read(file, magic):
+    try:
+        with open(file, "rb") as f:
+            data = f.read()
+
+    except OSError:
+        return None
+
+    if len(data) < HEADER.size:
+        return None
+
+    file_magic, w, h = HEADER.unpack_from(data)
+
+    if file_magic != magic:
+        return None
+
+    return (w, h), memoryview(data)[HEADER.size:]
+
+
+def write(file, magic, size, payload):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+
+        tmp = f"{file}.{os.getpid()}.tmp"  # Write then rename so a crash never leaves a torn entry behind
+
+        with open(tmp, "wb") as f:
+            f.write(HEADER.pack(magic, *size))
+            f.write(payload)
+
+        os.replace(tmp, file)
+        prune(file)
+
+    except OSError:
+        pass  # A read-only install still works, it just decodes every launch
+
+
+def visible_area(source, size, clip, flip):
+    # The part of the source that lands inside clip once scaled to size, mirrored frames show their right edge
+    sw, sh = source
+    w, h = size
+
+    area = pygame.Rect(0, 0, min(math.ceil(min(clip[0], w) * sw / w), sw), min(math.ceil(min(clip[1], h) * sh / h), sh))
+
+    if flip:
+        area.right = sw
+
+    return area, (round(area.width * w / sw), round(area.height * h / sh))
+
+
+def decode(path, size=None, flip=False, colorkey=None, clip=None):
+    img = pygame.image.load(path)
+
+    if clip:  # Only scale what will be on screen, not the whole oversize frame
+        area, size = visible_area(img.get_size(), size or img.get_size(), clip, flip)
+        img = img.subsurface(area)
+
+    if colorkey:
+        img.set_colorkey(colorkey)
+
+    img = img.convert_alpha()
+
+    if size:
+        img = pygame.transform.scale(img, size)
+
+    if clip and (img.get_width() > clip[0] or img.get_height() > clip[1]):  # A non-integer scale can round a pixel past the clip
+        w, h = min(img.get_width(), clip[0]), min(img.get_height(), clip[1])
+        img = img.subsurface((img.get_width() - w if flip else 0, 0, w, h)).copy()
+
+    if flip:
+        img = pygame.transform.flip(img, True, False)
+
+    return img
+
+
+def optimize(img, rle=False):
+    # Cheapest blit the pixels of a convert_alpha() surface allow, per-pixel alpha is only kept where it is partly transparent
+    alpha = pygame.surfarray.pixels_alpha(img)
+    opaque = alpha.min() == 255
+    partial = not opaque and bool(((alpha - 1) < 254).any())  # 1-254 wrap around to 0-253, 0 to 255
+    del alpha  # Unlocks the surface
+
+    if opaque:
+        return img.convert()
+
+    if partial:
+        if rle:
+            img.set_alpha(255, pygame.RLEACCEL)  # Runs of fully transparent pixels are still skipped
+
+        return img
+
+    # Binary alpha, a colorkey no visible pixel uses blits the same and RLE skips the transparent runs outright
+    pixels = pygame.surfarray.pixels2d(img)
+    key = next((color for color in COLORKEYS if not (pixels == img.map_rgb(color + (255,))).any()), None)
+    del pixels
+
+    if key is None:
+        return img
+
+    keyed = pygame.Surface(img.get_size()).convert()
+    keyed.fill(key)
+    keyed.blit(img, (0, 0))
+    keyed.set_colorkey(key, pygame.RLEACCEL if rle else 0)  # Encoded on the first blit, only pays off for images blitted again and again
+
+    return keyed
+
+
+def mask_to_bytes(mask):
+    surface = mask.to_surface(setcolor=(255, 255, 255, 255), unsetcolor=(0, 0, 0, 255))
+    return pygame.image.tostring(surface, "RGBA")[::4]  # One byte per pixel, 0 or 255
+
+
+def mask_from_bytes(data, size):
+    surface = pygame.image.frombuffer(data, size, "P")
+    surface.set_colorkey(0)
+
+    return pygame.mask.from_surface(surface)
+
+
+def load_image(path, size=None, flip=False, clip=None, rle=False):
+    file = cache_path("img", path, size, flip, None, clip)
+    cached = read(file, b"TCIM")
+
+    if cached:
+        return optimize(pygame.image.frombuffer(cached[1], cached[0], "RGBA").convert_alpha(), rle)
+
+    img = decode(path, size, flip, clip=clip)
+    w, h = img.get_size()
+
+    if w * h * 4 <= MAX_ENTRY_BYTES:
+        write(file, b"TCIM", (w, h), pygame.image.tostring(img, "RGBA"))  # Stored with its alpha, optimized again on every load
+
+    return optimize(img, rle)
+
+
+def load_mask(path, size=None, flip=False, colorkey=None, clip=None):
+    file = cache_path("mask", path, size, flip, colorkey, clip)
+    cached = read(file, b"TCMK")
+
+    if cached:
+        return mask_from_bytes(zlib.decompress(cached[1]), cached[0])
+
+    mask = pygame.mask.from_surface(decode(path, size, flip, colorkey, clip))
+    write(file, b"TCMK", mask.get_size(), zlib.compress(mask_to_bytes(mask), 1))
+
+    return mask
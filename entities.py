@@ -1,77 +1,199 @@
 import pygame
-from math import sqrt
-from sprites import player
+import numpy as np
+import cache
+from assets import registry
+from tools import Animation, Atlas
+import sprites
+from profiler import profiler
 
 
-class Ghost:
-    def __init__(self, x, y, color):
-        self.images = []
+ghost_atlases = {}  # Four directional frames per colour, packed once for the whole process and drawn by every swarm
 
-        for direction in ["up", "right", "down", "left"]:
-            img = pygame.image.load(f"sprites/ghosts/ghost_{color}_{direction}.png").convert_alpha()
-            img = pygame.transform.scale(img, (40, 40))
-            self.images.append(img)
 
-        self.rect = pygame.Rect(x, y, self.images[0].get_width(), self.images[0].get_height())
-        self.precise_mask = pygame.mask.from_surface(self.images[0])
+def round_half_away(values):
+    return np.trunc(values + np.copysign(0.5, values)).astype(int)  # Same rounding pygame.Rect applies to floats
+
+
+def ghost_atlas(color):
+    if color not in ghost_atlases:
+        files = [f"sprites/ghosts/ghost_{color}_{direction}.png" for direction in ["up", "right", "down", "left"]]
+        ghost_atlases[color] = Atlas([cache.load_image(file, (40, 40)) for file in files])
+
+    return ghost_atlases[color]
 
-        self.vx = 0
-        self.vy = 0
 
-        self.x = x
-        self.y = y
+class GhostSwarm:
+    def __init__(self, ghost_list):
+        self.assets = []
+        self.masks = {}
+        self.atlases = {}
+
+        self.colors = []
+        self.w, self.h = 40, 40
+
+        # Rows are x and y, x/y/vx/vy are views so single rows can still be read and written directly
+        self.pos = np.zeros((2, 0))
+        self.vel = np.zeros((2, 0))
+        self.prev = np.zeros((2, 0))
+        self.direction = np.zeros(0, dtype=int)
+        self.pathing = np.zeros(0, dtype=bool)  # Follows the stage's flow field around walls instead of flying straight through
+        self.groups = np.zeros(0, dtype=int)  # Whatever spawned the ghost, e.g. a tower floor, so they can be despawned together
 
         self.accel = 0.05
         self.max_speed = 2
-        self.direction = None
+        self.brake_distance = 40  # Pathing ghosts slow down inside this many pixels of where they're heading
 
-    def update(self, player, dt):
-        dx = player.rect.x - self.rect.x
-        dy = player.rect.y - self.rect.y
+        self.spawn(ghost_list)
 
-        dc = sqrt(dx ** 2 + dy ** 2)  # Calculate magnitude of vector
-        ratio = self.accel / dc  # Calculate ratio between acceleration speed and magnitude
+    def load(self, color):
+        if color in self.masks:
+            return
 
-        accel_x = dx * ratio  # Calculate normilized vectors
-        accel_y = dy * ratio
+        asset = registry.acquire(f"sprites/ghosts/ghost_{color}_up.png", (40, 40))  # Only the mask comes from here, the frames from the atlas
+        self.assets.append(asset)
 
-        self.vx += accel_x * dt * 125  # Apply acceleration
-        self.vy += accel_y * dt * 125
+        self.masks[color] = asset.mask
+        self.atlases[color] = ghost_atlas(color)
 
-        dc = sqrt(self.vx ** 2 + self.vy ** 2)  # Calculate magnitude of vector
-        ratio = self.max_speed / dc  # Calculate ratio between acceleration speed and magnitude
+    def spawn(self, ghost_list, group=-1):
+        # Each ghost is (x, y, color) or (x, y, color, "pathing")
+        for ghost in ghost_list:
+            self.load(ghost[2])
 
-        if ratio < 1:
-            self.vx *= ratio
-            self.vy *= ratio
+        self.colors.extend(ghost[2] for ghost in ghost_list)
+        self.pathing = np.concatenate([self.pathing, np.array([len(ghost) > 3 and ghost[3] == "pathing" for ghost in ghost_list], dtype=bool)])
+        self.groups = np.concatenate([self.groups, np.full(len(ghost_list), group, dtype=int)])
 
-        self.x += self.vx * dt * 125
-        self.y += self.vy * dt * 125
+        pos = np.array([ghost[:2] for ghost in ghost_list], dtype=float).reshape(-1, 2).T
 
-        self.rect.x = self.x
-        self.rect.y = self.y
+        self.pos = np.concatenate([self.pos, pos], axis=1)
+        self.vel = np.concatenate([self.vel, np.zeros_like(pos)], axis=1)
+        self.prev = np.concatenate([self.prev, pos], axis=1)
+        self.rounded = round_half_away(self.pos)  # Where pygame.Rect would put each ghost
+        self.direction = np.concatenate([self.direction, np.zeros(len(ghost_list), dtype=int)])
 
-        if abs(dx) > abs(dy):
-            self.direction = 1 if dx > 0 else 3
-        else:
-            self.direction = 2 if dy > 0 else 0
+        self.bind()
+
+    def despawn(self, group):
+        keep = self.groups != group
+
+        self.colors = [color for color, kept in zip(self.colors, keep.tolist()) if kept]
+        self.pathing = self.pathing[keep]
+        self.groups = self.groups[keep]
+
+        self.pos = self.pos[:, keep]
+        self.vel = self.vel[:, keep]
+        self.prev = self.prev[:, keep]
+        self.rounded = self.rounded[:, keep]
+        self.direction = self.direction[keep]
+
+        self.bind()
+
+    def bind(self):
+        self.x, self.y = self.pos  # Views again after the arrays were replaced
+        self.vx, self.vy = self.vel
+        self.prev_x, self.prev_y = self.prev
+
+    def __len__(self):
+        return len(self.colors)
+
+    def rects(self):
+        return [pygame.Rect(x, y, self.w, self.h) for x, y in zip(*self.rounded.tolist())]
+
+    def settle(self):
+        self.prev[:] = self.pos
+        self.rounded = round_half_away(self.pos)
+
+    def snapshot(self):
+        return tuple(self.colors), self.pathing.copy(), self.groups.copy(), self.pos.copy(), self.vel.copy(), self.prev.copy(), self.direction.copy()
+
+    def restore(self, snapshot):
+        colors, pathing, groups, pos, vel, prev, direction = snapshot
+
+        for color in colors:
+            self.load(color)  # A swarm built fresh for the snapshot has none of the colours spawned since
+
+        self.colors = list(colors)
+        self.pathing = pathing.copy()
+        self.groups = groups.copy()
+
+        self.pos = pos.copy()
+        self.vel = vel.copy()
+        self.prev = prev.copy()
+        self.rounded = round_half_away(self.pos)
+        self.direction = direction.copy()
+
+        self.bind()
+
+    def update(self, player, dt, field=None):
+        self.prev[:] = self.pos
+
+        goal = np.array(player.rect.topleft)[:, None]
+
+        if field is not None and self.pathing.any():
+            field.aim(player.rect.topleft)  # Only floods again once the player is in a new cell
+            goal = np.where(self.pathing, field.targets(self.rounded, player.rect.topleft), goal)
+
+        delta = goal - self.rounded
+
+        dc = np.sqrt((delta ** 2).sum(axis=0))  # Calculate magnitude of vectors
+        ratio = self.accel / np.where(dc > 0, dc, np.inf)  # No pull when sitting on the player
+        pull = delta * ratio
+
+        if self.pathing.any():
+            # Steer the velocity onto the path and ease off near each waypoint, plain pull swings wide through walls
+            desired = delta * np.minimum(self.max_speed / np.where(dc > 0, dc, np.inf), self.max_speed / self.brake_distance)
+            steer = desired - self.vel
+            sc = np.sqrt((steer ** 2).sum(axis=0))
+            steer *= np.minimum(self.accel / np.where(sc > 0, sc, np.inf), 1)
+
+            pull = np.where(self.pathing, steer, pull)
+
+        self.vel += pull * dt * 125  # Apply normalized acceleration
+
+        dc = np.sqrt((self.vel ** 2).sum(axis=0))
+        self.vel *= np.minimum(self.max_speed / np.where(dc > 0, dc, np.inf), 1)  # Clamp to max_speed
+
+        self.pos += self.vel * dt * 125
+        self.rounded = round_half_away(self.pos)
+
+        dx, dy = delta
+        self.direction = np.where(np.abs(dx) > np.abs(dy), np.where(dx > 0, 1, 3), np.where(dy > 0, 2, 0))
 
     def check_collision(self, player):
-        offset_x = self.rect.x - player.rect.x
-        offset_y = self.rect.y - player.rect.y
+        x, y = self.rounded
+        rect = player.rect
+
+        hits = (x < rect.right) & (x + self.w > rect.left) & (y < rect.bottom) & (y + self.h > rect.top)  # Broad-phase
+
+        for index in np.flatnonzero(hits):
+            offset = (int(x[index]) - rect.x, int(y[index]) - rect.y)
+
+            if player.animation.mask.overlap(self.masks[self.colors[index]], offset):
+                return True
+
+        return False
+
+    def draw(self, screen, alpha, scroll=0):
+        x = round_half_away(self.prev_x + (self.x - self.prev_x) * alpha)
+        y = round_half_away(self.prev_y + (self.y - self.prev_y) * alpha) - scroll
+
+        frames = {color: (atlas.surface, atlas.rects) for color, atlas in self.atlases.items()}
+        blits = [(frames[color][0], (left, top), frames[color][1][direction]) for color, direction, left, top in zip(self.colors, self.direction.tolist(), x.tolist(), y.tolist())]
 
-        return player.sprite_group.mask.overlap(self.precise_mask, (offset_x, offset_y))
+        return screen.blits(blits)
 
-    def draw(self, screen):
-        img = self.images[self.direction]
-        screen.blit(img, self.rect)
+    def destroy(self):
+        for asset in self.assets:
+            registry.release(asset)
+
+        self.assets.clear()
 
 
 class Player:
     def __init__(self, x, y):
-        self.sprite_group = player
-
         self.rect = pygame.Rect(x, y, 45, 51)
+        self.prev_pos = self.rect.topleft
 
         self.mask = pygame.mask.Mask((self.rect.width, self.rect.height))
         self.mask.fill()
@@ -83,17 +205,31 @@ class Player:
         self.dunked = False
         self.left = False
 
-        self.set_sprite_rules()
+        self.animation = Animation(sprites.get("player"), self.pose())
+
+    def pose(self):
+        if self.dunked:
+            return "dunking"
+
+        if not self.on_ground:
+            return "falling" if self.vy > 0 else "jumping"
+
+        return "walking" if self.vx != 0 else "standing"
+
+    def set_pose(self):
+        self.animation.play(self.pose())  # Called wherever dunked, on_ground, vx or vy change
+
+    def settle(self):
+        self.prev_pos = self.rect.topleft
 
-    def set_sprite_rules(self):
-        self.sprite_group.rules.clear()
+    def snapshot(self):
+        return tuple(self.rect), self.prev_pos, self.vx, self.vy, self.on_ground, self.dunked, self.left, self.animation.snapshot()
 
-        self.sprite_group.add_rule(lambda: self.dunked, "dunking")
-        self.sprite_group.add_rule(lambda: not self.on_ground and self.vy > 0, "falling")
-        self.sprite_group.add_rule(lambda: not self.on_ground, "jumping")
-        self.sprite_group.add_rule(lambda: self.vx != 0, "walking")
-        self.sprite_group.add_rule(lambda: self.on_ground, "standing")
-        self.sprite_group.set_mirror(lambda: self.left)
+    def restore(self, snapshot):
+        rect, self.prev_pos, self.vx, self.vy, self.on_ground, self.dunked, self.left, animation = snapshot
+
+        self.rect.update(rect)
+        self.animation.restore(animation)
 
     def update_on_ground(self, stage):
         self.rect.y += 1
@@ -103,26 +239,28 @@ class Player:
         if self.on_ground:
             self.vy = 0
             self.land()
+        else:
+            self.set_pose()
 
     def check_collision(self, stage):
-        offset_x = self.rect.x
-        offset_y = self.rect.y
-
-        return stage.mask.overlap(self.mask, (offset_x, offset_y))
+        return stage.overlap(self.mask, self.rect.topleft)
 
     def jump(self):
         if self.on_ground:
             self.vy -= 6.5
             self.on_ground = False
+            self.set_pose()
 
     def land(self):
         self.on_ground = True
         self.dunked = False
+        self.set_pose()
 
     def dunk(self):
         if not self.on_ground and not self.dunked:
             self.vy = 10
             self.dunked = True
+            self.set_pose()
 
     def get_keys(self, keys):
         self.vx = 0
@@ -132,6 +270,8 @@ class Player:
         if keys[pygame.K_RIGHT]:
             self.vx += 3
 
+        self.set_pose()
+
     def get_event(self, event):
         if event.type == pygame.KEYDOWN:
             if event.key == pygame.K_UP:
@@ -140,106 +280,65 @@ class Player:
             elif event.key == pygame.K_DOWN:
                 self.dunk()
 
-    def collide_vertical(self, stage, overlap):
+    def collide_vertical(self, stage):
         top = self.vy < 0
-        x = overlap[0]
-
-        if top:
-            y = overlap[1]
-
-            while stage.mask.get_at((x, y)):
-                y += 1
-
-            bounce = y - overlap[1]
 
-        else:
-            bounce = overlap[1] - (self.rect.y + self.rect.h)
-
-        self.rect.y += bounce
+        self.rect.y += stage.resolve(self.rect, 0, 1 if top else -1)  # Bounce down off ceilings, up off floors
 
         if not top:
             self.land()
 
-    def slow_collide_vertical(self, stage):
-        top = self.vy < 0
-
-        while self.check_collision(stage):
-            self.rect.y += 1 if top else -1
-
-        if not top:
-            self.land()
-
-    def collide_horizontal(self, stage, overlap):
+    def collide_horizontal(self, stage):
         left = self.vx < 0
-        y = overlap[1]
-
-        if left:
-            x = overlap[0]
-
-            while stage.mask.get_at((x, y)):
-                x += 1
-
-            bounce = x - overlap[0]
-
-        else:
-            x = self.rect.x + self.rect.w
-
-            while stage.mask.get_at((x, y)):
-                x -= 1
-
-            bounce = x - (self.rect.x + self.rect.w)
 
-        self.rect.x += bounce
-
-    def slow_collide_horizontal(self, stage):
-        left = self.vx < 0
-
-        while self.check_collision(stage):
-            self.rect.x += 1 if left else -1
+        self.rect.x += stage.resolve(self.rect, 1 if left else -1, 0)
 
     def update(self, stage, dt):
         if self.vx != 0:
             self.left = self.vx < 0
+            self.animation.face(self.left)
 
-        self.sprite_group.tick(dt)
-        update_rects = [self.rect.copy()]
+        self.settle()
+        self.animation.tick(dt)
 
         if not self.dunked:
-            self.rect.x += int(self.vx * dt * 125)
+            self.rect.x += stage.sweep(self.rect, int(self.vx * dt * 125), 0)  # Stop at the first wall in the way
 
             self.rect.x = max(self.rect.x, 0)
-            self.rect.x = min(self.rect.x, stage.image.get_width() - self.rect.w)
-
-            overlap = self.check_collision(stage)
-
-            if overlap:
-                self.collide_horizontal(stage, overlap)
+            self.rect.x = min(self.rect.x, stage.width - self.rect.w)
 
-            overlap = self.check_collision(stage)
-
-            if overlap:  # Still overlapping, switching to slow correction
-                self.slow_collide_horizontal(stage)
+            if self.check_collision(stage):  # Only when we started inside geometry
+                profiler.count("Player.resolve_x")
+                self.collide_horizontal(stage)
 
         if not self.on_ground:
             self.vy += 0.1 * dt * 125 if not self.dunked else 0
-            self.rect.y += int(self.vy * dt * 125)
-            overlap = self.check_collision(stage)
 
-            if overlap:
-                self.collide_vertical(stage, overlap)
+            step = int(self.vy * dt * 125)
+            moved = stage.sweep(self.rect, 0, step)
+            self.rect.y += moved
+
+            if moved != step:  # Hit a floor or ceiling along the way
+                profiler.count("Player.contact_y")
 
-                overlap = self.check_collision(stage)
+                if step > 0:
+                    self.land()
 
-                if overlap:
-                    self.slow_collide_vertical(stage)
+                self.vy = 0
 
+            elif self.check_collision(stage):
+                profiler.count("Player.resolve_y")
+                self.collide_vertical(stage)
                 self.vy = 0
 
+            self.set_pose()  # Gravity may have turned jumping into falling
+
         if self.on_ground:
             self.update_on_ground(stage)
 
-        update_rects.append(self.rect)
-        return update_rects
+    def draw(self, screen, alpha, scroll=0):
+        x, y = self.prev_pos
+        x += (self.rect.x - x) * alpha
+        y += (self.rect.y - y) * alpha
 
-    def draw(self, screen):
-        screen.blit(self.sprite_group.sprite, self.rect)
+        return self.animation.draw(screen, (int(x), int(y) - scroll))
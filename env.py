@@ -0,0 +1,256 @@
+import os
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")  # Simulation only, nothing is ever shown
+
+import multiprocessing
+import numpy as np
+import pygame
+
+pygame.display.init()
+
+if pygame.display.get_surface() is None:
+    pygame.display.set_mode((1, 1))  # convert_alpha() needs a display format, not a real window
+
+import states
+from levels import pack
+from replay import HeldKeys
+
+
+TICK = 1 / 120
+
+LEFT = 1
+RIGHT = 2
+JUMP = 4
+DUNK = 8
+
+NUM_ACTIONS = 16  # Any combination of the bits above
+OBS_SIZE = 9
+
+
+class ClimbEnv:
+    def __init__(self, start_level=None, frame_skip=4, max_steps=5000):
+        self.start_level = start_level or pack.ids[0]
+        self.frame_skip = frame_skip
+        self.max_steps = max_steps
+
+        self.surface = pygame.Surface((1, 1))  # Level.startup clears the screen, give it something cheap
+        self.start = None  # Built once, every reset restores its initial snapshot
+        self.level = None
+        self.backlog = []
+
+        self.steps = 0
+        self.height = 0
+
+    def load(self, level_id):
+        level = states.Level(level_id)
+        level.startup(self.surface)
+
+        return level
+
+    def dismiss(self):
+        for level in self.backlog + [self.level]:
+            if level is not None and level is not self.start:
+                level.destroy()
+
+        self.backlog.clear()
+        self.level = None
+
+    def close(self):
+        self.dismiss()
+
+        if self.start is not None:
+            self.start.destroy()
+            self.start = None
+
+    def reset(self):
+        self.dismiss()
+
+        if self.start is None:
+            self.start = self.load(self.start_level)
+        else:
+            self.start.restore(self.start.initial)
+            self.start.restart()
+
+        self.level = self.start
+        self.steps = 0
+        self.height = self.climbed()
+
+        return self.observe()
+
+    def climbed(self):
+        stage_height = self.level.stage.image.get_height()
+        floor = pack.number(self.level.id) - 1
+
+        return floor * stage_height + stage_height - self.level.player.rect.bottom
+
+    def observe(self):
+        level = self.level
+        player = level.player
+        w, h = level.stage.image.get_size()
+
+        obs = np.zeros(OBS_SIZE, dtype=np.float32)
+        obs[:6] = player.rect.x / w, player.rect.y / h, player.vx, player.vy, player.on_ground, player.dunked
+        obs[6] = pack.number(level.id) / len(pack)
+
+        if len(level.ghosts):
+            dx = level.ghosts.x - player.rect.x
+            dy = level.ghosts.y - player.rect.y
+            nearest = np.argmin(dx ** 2 + dy ** 2)
+
+            obs[7:] = dx[nearest] / w, dy[nearest] / h
+
+        return obs
+
+    def flip(self):
+        # Mirrors Control.flip_state for the transitions a level can request, returns (reward, done)
+        level = self.level
+
+        if level.next == "menu":  # Caught by a ghost
+            return -1.0, True
+
+        if level.next == "win":
+            return 1.0, True
+
+        if level.next is None:
+            if not self.backlog:
+                return -1.0, True
+
+            self.level = self.backlog.pop()
+            self.level.restart(*level.next_args)
+            level.destroy()
+
+            return 0.0, False
+
+        self.backlog.append(level)
+        self.level = self.load(level.next)
+
+        return 0.0, False
+
+    def step(self, action):
+        player = self.level.player
+        keys = HeldKeys({key for bit, key in ((LEFT, pygame.K_LEFT), (RIGHT, pygame.K_RIGHT)) if action & bit})
+
+        if action & JUMP:
+            player.jump()
+
+        if action & DUNK:
+            player.dunk()
+
+        reward, done = 0.0, False
+
+        for _ in range(self.frame_skip):
+            self.level.get_keys(keys)
+            self.level.update(TICK)
+
+            if self.level.done:
+                reward, done = self.flip()
+
+                if done:
+                    break
+
+        self.steps += 1
+
+        height = self.climbed() if not done else self.height
+        reward += (height - self.height) / 864  # One screen of climbing is worth one point
+        self.height = height
+
+        truncated = self.steps >= self.max_steps
+
+        return self.observe(), reward, done or truncated, {"level": self.level.id, "truncated": truncated and not done}
+
+
+class VectorEnv:
+    def __init__(self, count, **kwargs):
+        self.envs = [ClimbEnv(**kwargs) for _ in range(count)]
+
+    def __len__(self):
+        return len(self.envs)
+
+    def reset(self):
+        return np.stack([env.reset() for env in self.envs])
+
+    def step(self, actions):
+        obs = np.empty((len(self.envs), OBS_SIZE), dtype=np.float32)
+        rewards = np.empty(len(self.envs), dtype=np.float32)
+        dones = np.empty(len(self.envs), dtype=bool)
+        infos = []
+
+        for index, (env, action) in enumerate(zip(self.envs, actions)):
+            obs[index], rewards[index], dones[index], info = env.step(int(action))
+
+            if dones[index]:  # Auto-reset so the batch never stalls, the final obs is kept in info
+                info["final_obs"] = obs[index].copy()
+                obs[index] = env.reset()
+
+            infos.append(info)
+
+        return obs, rewards, dones, infos
+
+    def close(self):
+        for env in self.envs:
+            env.close()
+
+
+def worker(pipe, count, kwargs):
+    envs = VectorEnv(count, **kwargs)
+
+    while True:
+        command, data = pipe.recv()
+
+        if command == "reset":
+            pipe.send(envs.reset())
+
+        elif command == "step":
+            pipe.send(envs.step(data))
+
+        elif command == "close":
+            envs.close()
+            pipe.close()
+            break
+
+
+class ProcessVectorEnv:
+    def __init__(self, workers=None, envs_per_worker=64, **kwargs):
+        workers = workers or os.cpu_count()
+        context = multiprocessing.get_context("spawn")  # Every worker sets up its own headless SDL
+
+        self.pipes = []
+        self.processes = []
+        self.envs_per_worker = envs_per_worker
+
+        for _ in range(workers):
+            parent, child = context.Pipe()
+            process = context.Process(target=worker, args=(child, envs_per_worker, kwargs), daemon=True)
+            process.start()
+
+            self.pipes.append(parent)
+            self.processes.append(process)
+
+    def __len__(self):
+        return len(self.pipes) * self.envs_per_worker
+
+    def reset(self):
+        for pipe in self.pipes:
+            pipe.send(("reset", None))
+
+        return np.concatenate([pipe.recv() for pipe in self.pipes])
+
+    def step(self, actions):
+        for index, pipe in enumerate(self.pipes):
+            pipe.send(("step", actions[index * self.envs_per_worker:(index + 1) * self.envs_per_worker]))
+
+        results = [pipe.recv() for pipe in self.pipes]
+
+        obs = np.concatenate([result[0] for result in results])
+        rewards = np.concatenate([result[1] for result in results])
+        dones = np.concatenate([result[2] for result in results])
+        infos = [info for result in results for info in result[3]]
+
+        return obs, rewards, dones, infos
+
+    def close(self):
+        for pipe in self.pipes:
+            pipe.send(("close", None))
+
+        for process in self.processes:
+            process.join()
@@ -0,0 +1,254 @@
+import pygame
+import json
+import mmap
+import os
+import struct
+import weakref
+import numpy as np
+from cache import mask_from_bytes, optimize
+from tools import RunTable
+from pathing import CELL, walkable
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+MANIFEST = "levels.json"
+PACK = "levels.pack"
+
+MAGIC = b"TCLP"
+VERSION = 2
+HEADER = struct.Struct("<4sHI")  # Magic, version, length of the JSON index that follows
+ALIGN = 64  # Blobs start on cache-line boundaries inside the mapping
+
+
+def read_manifest(manifest=MANIFEST):
+    with open(manifest) as f:
+        return json.load(f)["levels"]
+
+
+def stale(manifest=MANIFEST, path=PACK):
+    if not os.path.exists(path):
+        return True
+
+    built = os.path.getmtime(path)
+    sources = [manifest] + [spec[kind] for spec in read_manifest(manifest) for kind in ("art", "mask")]
+
+    return any(os.path.getmtime(source) > built for source in sources)
+
+
+def solid_pixels(path):
+    img = pygame.image.load(path)
+    w, h = img.get_size()
+    rgba = np.frombuffer(pygame.image.tostring(img, "RGBA"), dtype=np.uint8).reshape(h, w, 4)
+
+    return (rgba[..., 3] > 127) & (rgba[..., :3] != 255).any(axis=2)  # White is the mask PNGs' colorkey
+
+
+def user_pack(path=PACK):
+    # Where the pack goes when the install directory is read-only
+    root = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(root, "towerclimberen", os.path.basename(path))
+
+
+def encode(manifest=MANIFEST):
+    index = []
+    blobs = []
+    offset = 0
+
+    for spec in read_manifest(manifest):
+        art = pygame.image.load(spec["art"])
+        pixels = pygame.image.tostring(art, "RGBA")  # Pre-converted, loading is a copy out of the mapping
+        solid = solid_pixels(spec["mask"])
+        bits = np.packbits(solid).tobytes()  # One bit per pixel, row-major
+
+        mask = mask_from_bytes(solid.astype(np.uint8).tobytes(), art.get_size())
+        runs = RunTable(mask).to_bytes()  # Span tables are the slow part of loading a level, so they ship prebuilt
+        grid = np.packbits(walkable(mask)).tobytes()  # Cells a pathing ghost fits in, thousands of overlap tests otherwise
+
+        entry = {
+            "id": spec["id"],
+            "size": art.get_size(),
+            "start": spec["start"],
+            "next": spec["next"],
+            "first": spec.get("first", False),
+            "ghosts": spec.get("ghosts", [])
+        }
+
+        for kind, blob in (("art", pixels), ("mask", bits), ("runs", runs), ("walkable", grid)):
+            entry[kind] = (offset, len(blob))
+            padding = -len(blob) % ALIGN
+
+            blobs.append(blob + bytes(padding))
+            offset += len(blob) + padding
+
+        index.append(entry)
+
+    header = json.dumps(index).encode()
+    header += b" " * (-(HEADER.size + len(header)) % ALIGN)
+
+    return [HEADER.pack(MAGIC, VERSION, len(header)), header] + blobs
+
+
+def build(manifest=MANIFEST, path=PACK):
+    parts = encode(manifest)
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"  # Write then rename, other processes may be mapping the old pack
+
+    with open(tmp, "wb") as f:
+        f.writelines(parts)
+
+    os.replace(tmp, path)
+
+
+class Decoded:
+    # One level's surfaces, span table and pathing grid, alive while the cache or any stage holds it
+    def __init__(self, image, mask, runs, walkable):
+        self.image = image
+        self.mask = mask
+        self.runs = runs
+        self.walkable = walkable
+
+
+class LevelPack:
+    def __init__(self, path=PACK, cache_size=3, data=None):
+        if data is None:
+            with open(path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.data = data  # The mapped file, or the whole pack in memory when it could not be written anywhere
+
+        magic, version, length = HEADER.unpack_from(self.data)
+
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} level pack")
+
+        index = json.loads(self.data[HEADER.size:HEADER.size + length])
+
+        self.base = HEADER.size + length
+        self.ids = [entry["id"] for entry in index]
+        self.levels = {entry["id"]: entry for entry in index}
+
+        self.cache_size = cache_size  # Decoded levels kept, the current one and its neighbours
+        self.cache = OrderedDict()
+        self.live = weakref.WeakValueDictionary()  # Every decoded level still in use, however long ago the cache dropped it
+        self.pending = {}
+        self.executor = None
+
+    def __contains__(self, level_id):
+        return level_id in self.levels
+
+    def __len__(self):
+        return len(self.ids)
+
+    def number(self, level_id):
+        return self.ids.index(level_id) + 1
+
+    def blob(self, level_id, kind):
+        offset, length = self.levels[level_id][kind]
+        start = self.base + offset
+
+        return memoryview(self.data)[start:start + length]
+
+    def decode(self, level_id):
+        size = tuple(self.levels[level_id]["size"])
+        image = optimize(pygame.image.frombuffer(self.blob(level_id, "art"), size, "RGBA").convert_alpha())  # Opaque art blits without alpha
+
+        bits = np.frombuffer(self.blob(level_id, "mask"), dtype=np.uint8)
+        mask = mask_from_bytes(np.unpackbits(bits, count=size[0] * size[1]).tobytes(), size)
+
+        rows, cols = size[1] // CELL, size[0] // CELL
+        grid = np.unpackbits(np.frombuffer(self.blob(level_id, "walkable"), dtype=np.uint8), count=rows * cols).reshape(rows, cols).astype(bool)
+
+        return Decoded(image, mask, RunTable.from_bytes(self.blob(level_id, "runs"), size), grid)
+
+    def get(self, level_id):
+        if level_id in self.cache:
+            self.cache.move_to_end(level_id)
+            return self.cache[level_id]
+
+        level = self.live.get(level_id)  # A stage still holds it, share that copy instead of decoding another
+
+        if level is None:
+            if level_id in self.pending:
+                level = self.pending.pop(level_id).result()
+            else:
+                level = self.decode(level_id)
+
+            self.live[level_id] = level
+
+        self.cache[level_id] = level
+
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        return level
+
+    def trim(self):
+        self.cache.clear()  # Stages still hold the levels they use, the rest is decoded again on the next get
+
+        for future in self.pending.values():
+            future.cancel()
+
+        self.pending.clear()
+
+    def prefetch(self, level_id):
+        if level_id not in self.levels or level_id in self.cache or level_id in self.live or level_id in self.pending:
+            return
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+
+        self.pending[level_id] = self.executor.submit(self.decode, level_id)
+
+
+def load(manifest, path):
+    if not stale(manifest, path):
+        try:
+            return LevelPack(path)
+        except ValueError:
+            pass  # Written by another version of the game
+
+    build(manifest, path)  # First run, an edited level or a format change, a few hundred ms once
+
+    return LevelPack(path)
+
+
+def open_pack(manifest=MANIFEST, path=PACK):
+    for candidate in (path, user_pack(path)):
+        try:
+            return load(manifest, candidate)
+        except OSError:
+            pass  # Not writable, try the next place
+
+    return LevelPack(data=b"".join(encode(manifest)))  # Nowhere to keep it, built again every launch
+
+
+class LazyPack:
+    # Stands in for the pack until something needs it, importing the game never builds or maps it
+    def __init__(self, manifest=MANIFEST, path=PACK):
+        self.manifest = manifest
+        self.path = path
+        self.pack = None
+
+    def open(self):
+        if self.pack is None:
+            self.pack = open_pack(self.manifest, self.path)
+
+        return self.pack
+
+    def __getattr__(self, name):
+        return getattr(self.open(), name)
+
+    def __contains__(self, level_id):
+        return level_id in self.open()
+
+    def __len__(self):
+        return len(self.open())
+
+
+if __name__ == "__main__":
+    build()
+    print(f"packed {len(read_manifest())} levels into {PACK}")
+else:
+    pack = LazyPack()
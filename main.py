@@ -1,49 +1,179 @@
 import pygame
+import argparse
+import random
+import states
+import replay
+import sprites
+import memory
+from assets import registry
+from entities import ghost_atlas
+from collections import OrderedDict, deque
+from profiler import profiler
+from levels import pack, read_manifest
 
 
-pygame.init()
-pygame.display.set_caption("Tower Climberen")
-info = pygame.display.Info()
-screen = pygame.display.set_mode((960, 864))
+FPS = 120  # Render cap
+TICK_RATE = 120  # Fixed simulation steps per second
+MAX_FRAME_TIME = 0.25  # Drop simulation time after a stall instead of spiralling
+IDLE_TIMEOUT = 500  # Milliseconds an idle screen sleeps waiting for input before looping anyway
+SIZE = (960, 864)  # Logical resolution, everything is drawn and laid out at this size
+TRANSITIONS_KEPT = 64  # Most recent state flips whose frame time --frame-stats reports
 
+screen = None
 
-import states
 
+def bootstrap(size=SIZE, scaled=False):
+    global screen
+
+    if screen is None:
+        pygame.init()
+        pygame.display.set_caption("Tower Climberen")
+
+        # Scaled windows keep the logical surface and let SDL stretch each finished frame to the window once
+        screen = pygame.display.set_mode(size, pygame.SCALED | pygame.RESIZABLE if scaled else 0)
+
+    return screen
+
+
+def warmup_steps():
+    # One step per frame once the menu is up: what the first floor needs, then what the victory screen needs
+    steps = [lambda: sprites.get("player")]
+
+    for color in sorted({ghost[2] for level_id in pack.ids for ghost in pack.levels[level_id]["ghosts"]}):
+        steps.append(lambda color=color: registry.prefetch(f"sprites/ghosts/ghost_{color}_up.png", (40, 40), image=False))
+        steps.append(lambda color=color: ghost_atlas(color))
+
+    steps.append(lambda: pack.prefetch(pack.ids[0]))
+    steps.append(lambda: pack.prefetch(pack.levels[pack.ids[0]]["next"]))
+    steps.append(lambda: sprites.get("confetti"))
+
+    for path in ["sprites/victory.png", "sprites/restart_button.png", "sprites/menu_button.png"]:
+        steps.append(lambda path=path: registry.prefetch(path))
+
+    return steps
 
-FPS = 120
+
+def seed_value(text):
+    seed = int(text)
+
+    if not 0 <= seed < 2 ** 64:
+        raise argparse.ArgumentTypeError(f"{text} is not a seed from 0 to 2**64 - 1, replay logs store it unsigned")
+
+    return seed
 
 
 class Control:
-    def __init__(self, start_state):
-        self.screen = screen
+    def __init__(self, start_state, fps=FPS, seed=None, recorder=None, pool_size=4, memory_budget=None):
+        self.screen = bootstrap()
         self.clock = pygame.time.Clock()
         self.running = True
 
-        self.state = state_dict[start_state](start_state)
-        self.state.startup(self.screen)
-        self.backlog_state = []
+        self.seed = seed if seed is not None else random.getrandbits(32)
+        states.rng.seed(self.seed)  # Everything random in the simulation draws from this
+        self.recorder = recorder
+        self.profile_path = None
+
+        self.fps = fps
+        self.step = 1 / TICK_RATE
+        self.accumulator = self.step
+
+        self.pool = OrderedDict()  # Dismissed reusable states by id, least recently used first
+        self.pool_size = pool_size
+        self.backlog_state = []  # (state id, snapshot) of every preserved state, the state itself waits in the pool
+
+        self.memory_budget = memory_budget  # Bytes of surfaces, masks and span tables allowed after a flip, None for no limit
+        self.memory_log = []  # (state id, bytes held, what was evicted) after every flip
+        self.report_memory = False
+
+        self.state = self.summon(start_state)
+        self.loading = deque()  # Deferred asset loads, main_game_loop runs one per frame
+
+        self.flipped = False
+        self.frame_stats_enabled = False  # Frames are only timed when asked for, a long session keeps nothing otherwise
+        self.frames = 0
+        self.worst_frame = 0
+        self.worst_transition = 0
+        self.transition_times = deque(maxlen=TRANSITIONS_KEPT)
+
+    def park(self, state):
+        if not state.reusable:
+            state.destroy()  # Call the cleaner
+            return
+
+        self.pool[state.id] = state
+        self.pool.move_to_end(state.id)
+
+        while len(self.pool) > self.pool_size:
+            self.pool.popitem(last=False)[1].destroy()
+
+    def summon(self, state_id, snapshot=None, args=(), kwargs={}):
+        if state_id in self.pool:  # Restore instead of rebuilding, the heavy assets never left
+            state = self.pool.pop(state_id)
+            state.restore(state.initial if snapshot is None else snapshot)
+            state.restart()
+
+            return state
+
+        state = state_dict[state_id](state_id, *args, **kwargs)  # Initialize new state
+        state.startup(self.screen)  # Initialize startup function
+
+        if snapshot is not None:  # Was evicted from the pool while backlogged
+            state.restore(snapshot)
+
+        return state
 
     def flip_state(self):
         state_id = self.state.next
+        args, kwargs = self.state.next_args, self.state.next_kwargs
+        self.flipped = True
+
+        if state_id is None and not self.backlog_state:  # Started mid-tower, there is nothing to fall back into
+            state_id, args, kwargs = "menu", [], {}
+
+        previous = self.state
 
         if state_id is None:
-            backlogged = self.backlog_state.pop()  # Pop the last state off the stack
+            state_id, snapshot = self.backlog_state.pop()  # Pop the last state off the stack
 
-            backlogged.restart(*self.state.next_args, **self.state.next_kwargs)  # Reinit the last state with args
-            self.state.destroy()  # Call the cleaner
-            self.state = backlogged  # Replace current state with backlogged state
+            self.park(previous)
+            self.state = self.summon(state_id, snapshot)
+            self.state.restart(*args, **kwargs)  # Reinit the last state with args
 
-            return
+        else:
+            if previous.preserve:  # Current state is to be preserved
+                self.backlog_state.append((previous.id, previous.snapshot()))
+            else:  # State is not preserved, drop the stack
+                self.backlog_state.clear()
 
-        if self.state.preserve:  # Current state is to be preserved
-            self.backlog_state.append(self.state)
+            self.park(previous)
+            self.state = self.summon(state_id, None, args, kwargs)
 
-        else:  # State is not preserved, destroy stack
-            self.state.destroy()
-            self.backlog_state.clear()
+        profiler.forget_overlay()
 
-        self.state = state_dict[state_id](state_id, *self.state.next_args, **self.state.next_kwargs)  # Initialize new state
-        self.state.startup(self.screen)  # Initialize startup function
+        if self.report_memory or self.memory_budget is not None:
+            self.account()  # About a millisecond, off unless asked for so restarts stay instant
+
+    def account(self):
+        with profiler.scope("memory"):
+            owners = memory.census(self)
+            evicted = []
+
+            if self.memory_budget is not None:
+                steps = memory.evictions(self)
+
+                while memory.total(owners) > self.memory_budget:
+                    step = next(steps, None)
+
+                    if step is None:  # Everything left is in use
+                        break
+
+                    evicted.append(step)
+                    owners = memory.census(self)
+
+        self.memory_log.append((self.state.id, memory.total(owners), evicted))
+
+        if self.report_memory:
+            print(memory.report(self.state.id, owners, evicted))
 
     def update(self, dt):
         if self.state.quit:
@@ -52,40 +182,191 @@ class Control:
         elif self.state.done:
             self.flip_state()
 
-        self.state.update(self.screen, dt)
+        with profiler.scope("State.update"):
+            self.state.update(dt)
 
-    def event_loop(self):
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                self.running = False
+    def simulate(self):
+        with profiler.scope("update"):
+            while self.accumulator >= self.step and self.running:
+                self.update(self.step)
+                self.accumulator -= self.step
 
-            self.state.get_event(event)
+    def draw(self, alpha):
+        with profiler.scope("draw"):
+            if profiler.overlay:
+                profiler.hide_overlay(self.screen)  # Give the state back the pixels it drew last frame
 
-        self.state.get_keys(pygame.key.get_pressed())
+            self.state.draw(self.screen, alpha)
 
-    def main_game_loop(self):
-        delta_time = 1 / FPS
+            if profiler.overlay:
+                self.state.update_rects.append(profiler.draw_overlay(self.screen))
+
+    def present(self):
+        with profiler.scope("display update"):
+            if self.state.redraw:
+                pygame.display.update()
+                self.state.redraw = False
+            else:
+                pygame.display.update(self.state.update_rects)
+
+            self.state.update_rects.clear()
 
+    def governor(self):
+        # Render rate for the next frame, 0 means nothing will change until input arrives
+        state = self.state
+
+        if state.frame_rate is None or state.redraw or state.done or state.quit or self.loading or profiler.overlay:
+            return self.fps
+
+        return min(state.frame_rate, self.fps)
+
+    def wait(self):
+        event = pygame.event.wait(IDLE_TIMEOUT)  # Sleeps in SDL, returns as soon as input arrives
+        self.clock.tick()  # The wait isn't frame time, don't feed it to the simulation
+
+        return [] if event.type == pygame.NOEVENT else [event]
+
+    def event_loop(self, pending=()):
+        events = list(pending) + pygame.event.get()
+        keys = pygame.key.get_pressed()
+
+        self.handle_input(events, keys)
+
+        if self.recorder:
+            self.recorder.input(events, keys)
+
+    def handle_input(self, events, keys):
+        with profiler.scope("event_loop"):
+            for event in events:
+                if event.type == pygame.QUIT:
+                    self.running = False
+
+                elif event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                    hidden = profiler.toggle_overlay(self.screen)
+
+                    if hidden:
+                        self.state.update_rects.append(hidden)
+
+                elif event.type == pygame.KEYDOWN and event.key == pygame.K_F4 and self.profile_path:
+                    profiler.export(self.profile_path)
+
+                self.state.get_event(event)
+
+            self.state.get_keys(keys)
+
+    def main_game_loop(self):
         while self.running:
-            self.event_loop()
-            self.update(delta_time)
-            pygame.display.update()  # self.state.update_rects
-            # self.state.update_rects.clear()
-            delta_time = self.clock.tick(FPS) / 1000.0
+            rate = self.governor()
+            pending = self.wait() if rate == 0 else []
+
+            profiler.begin_frame()
+
+            self.event_loop(pending)
+            self.simulate()
+            self.draw(self.accumulator / self.step)  # Blend between the last two simulation steps
+            self.present()
+
+            profiler.end_frame(self.state.id)
+
+            if self.loading:
+                self.loading.popleft()()
+
+            frame_time = min(self.clock.tick(rate or self.fps) / 1000.0, MAX_FRAME_TIME)
+            self.accumulator += frame_time
+
+            if self.recorder:
+                self.recorder.end_frame(frame_time)
+
+            if self.frame_stats_enabled:
+                self.record_frame()
+
+    def replay(self, frames):
+        # Same input and frame times as the recorded session, as fast as possible and without rendering
+        for frame_time, keys, events in frames:
+            if not self.running:
+                break
+
+            self.handle_input(events, keys)
+            self.simulate()
+            self.accumulator += frame_time
+
+    def record_frame(self):
+        frame_time = self.clock.get_rawtime()  # Milliseconds spent working, excluding the FPS cap delay
+        self.frames += 1
+        self.worst_frame = max(self.worst_frame, frame_time)
+
+        if self.flipped or self.state.crossed is not None:
+            self.worst_transition = max(self.worst_transition, frame_time)
+            self.transition_times.append((self.state.id if self.flipped else self.state.crossed, frame_time))
+            self.flipped = False
+            self.state.crossed = None
+
+    def frame_stats(self):
+        return {
+            "frames": self.frames,
+            "worst_frame_ms": self.worst_frame,
+            "worst_transition_ms": self.worst_transition,
+            "transitions": list(self.transition_times),
+            "peak_memory_mb": max((size for _, size, _ in self.memory_log), default=0) / 2 ** 20
+        }
 
 
 state_dict = {
     "menu": states.Menu,
-    "level1": states.Level1,
-    "level2": states.Level2,
-    "level3": states.Level3,
-    "level4": states.Level4,
-    "level5": states.Level5,
+    "tower": states.Tower,
     "pause": states.Pause,
     "win": states.Victory
 }
 
+state_dict.update((spec["id"], states.Level) for spec in read_manifest())  # Every level in the manifest, adding one needs no code
+
 
 if __name__ == "__main__":
-    cont = Control("menu")
-    cont.main_game_loop()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frame-stats", action="store_true", help="print worst frame times on exit")
+    parser.add_argument("--no-preload", action="store_true", help="decode each level and tower floor when it is reached instead of ahead of time")
+    parser.add_argument("--fps", type=int, default=FPS, help="render rate cap, simulation always runs at %d Hz" % TICK_RATE)
+    parser.add_argument("--seed", type=seed_value, help="seed for the simulation's random source")
+    parser.add_argument("--record", metavar="PATH", help="write this session's input to a replay log")
+    parser.add_argument("--replay", metavar="PATH", help="re-simulate a replay log headless and print the final state")
+    parser.add_argument("--profile", metavar="PATH", help="record per-frame scope timings, written as .jsonl or .csv on exit and on F4")
+    parser.add_argument("--scaled", action="store_true", help="resizable window, the %dx%d frame is scaled to fit it" % SIZE)
+    parser.add_argument("--memory", action="store_true", help="print the surface and mask memory held by each owner after every state flip")
+    parser.add_argument("--memory-budget", type=float, metavar="MB", help="evict cached assets and pooled states after a flip until under this")
+    args = parser.parse_args()
+
+    profiler.enabled = bool(args.profile)
+
+    states.Level.preload_next = states.Tower.preload_next = not args.no_preload
+
+    if args.replay:
+        start_state, seed, frames = replay.read(args.replay)
+
+        cont = Control(start_state, seed=seed)
+        cont.replay(frames)
+
+        print(replay.summary(cont))
+
+    else:
+        bootstrap(SIZE, args.scaled)
+
+        cont = Control("menu", args.fps, args.seed, memory_budget=args.memory_budget and args.memory_budget * 2 ** 20)
+        cont.report_memory = args.memory
+        cont.frame_stats_enabled = args.frame_stats
+        cont.loading.extend(warmup_steps())
+
+        cont.profile_path = args.profile
+
+        if args.record:
+            cont.recorder = replay.Recorder(args.record, "menu", cont.seed)
+
+        cont.main_game_loop()
+
+        if cont.recorder:
+            cont.recorder.close()
+
+        if cont.profile_path:
+            profiler.export(cont.profile_path)
+
+    if args.frame_stats:
+        print(cont.frame_stats())
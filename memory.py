@@ -0,0 +1,133 @@
+import pygame
+import numpy as np
+import sprites
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from assets import registry
+from levels import pack
+from profiler import profiler
+from tools import RunTable
+
+
+PROJECT = {"states", "entities", "tools", "assets", "levels", "pathing", "profiler"}  # Objects of these modules are walked into
+SCALARS = (int, float, str, bytes, type(None))
+MB = 2 ** 20
+
+
+def surface_bytes(surface):
+    if surface.get_parent() is not None:
+        return 0  # A subsurface shares its parent's pixels
+
+    return surface.get_pitch() * surface.get_height()
+
+
+def mask_bytes(mask):
+    w, h = mask.get_size()
+    return (w + 63) // 64 * 8 * h  # Rows are stored as whole 64 bit words
+
+
+def runs_bytes(runs):
+    return sum(len(starts) + len(ends) for starts, ends in runs.rows + runs.cols) * 2
+
+
+def held(obj, seen):
+    # Bytes of every Surface, Mask, span table and array reachable from obj that seen hasn't counted yet
+    if isinstance(obj, SCALARS) or id(obj) in seen:
+        return 0
+
+    seen.add(id(obj))
+
+    if isinstance(obj, pygame.Surface):
+        return surface_bytes(obj)
+
+    if isinstance(obj, pygame.mask.Mask):
+        return mask_bytes(obj)
+
+    if isinstance(obj, RunTable):
+        return runs_bytes(obj)
+
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+
+    if isinstance(obj, array):
+        return obj.itemsize * len(obj)
+
+    if isinstance(obj, Future):
+        return held(obj.result(), seen) if obj.done() and not obj.cancelled() and obj.exception() is None else 0  # A finished prefetch nobody has picked up yet
+
+    if isinstance(obj, dict):
+        return sum(held(value, seen) for value in obj.values())
+
+    if isinstance(obj, (list, tuple, set, frozenset, deque)):
+        return sum(held(value, seen) for value in obj)
+
+    if type(obj).__module__ in PROJECT and hasattr(obj, "__dict__"):
+        return held(vars(obj), seen)
+
+    return 0
+
+
+def census(control):
+    # Bytes per owner and part, shared caches first so a state is only charged for what nothing else keeps
+    seen = set()
+    owners = OrderedDict()
+
+    for name, group in sprites.groups.items():
+        owners[f"sprites.{name}"] = {"frames": held(group, seen)}
+
+    owners["registry"] = {"assets": held(registry, seen)}
+    owners["pack"] = {"levels": held(pack.cache, seen), "prefetched": held(pack.pending, seen)}
+    owners["profiler"] = {"overlay": held(profiler.backup, seen)}
+
+    for state in [control.state] + list(control.pool.values()):
+        owners[state.id] = {name: held(value, seen) for name, value in vars(state).items()}
+
+    owners["backlog"] = {"snapshots": held(control.backlog_state, seen)}
+
+    return owners
+
+
+def total(owners):
+    return sum(sum(parts.values()) for parts in owners.values())
+
+
+def evictions(control):
+    # One step per next(), cheapest to bring back first, everything dropped is reloaded or rebuilt on demand
+    if registry.idle:
+        registry.trim()
+        yield "idle assets"
+
+    for name, group in sprites.groups.items():
+        group.trim()
+        yield f"sprites.{name} cached frames"
+
+    if pack.cache or pack.pending:
+        pack.trim()
+        yield "decoded levels"
+
+    backlogged = {state_id for state_id, _ in control.backlog_state}  # Resumed from the pool, never rebuilt from a snapshot
+
+    for state_id in [state_id for state_id in control.pool if state_id not in backlogged]:
+        control.pool.pop(state_id).destroy()
+        yield f"pooled {state_id}"
+
+
+def report(state_id, owners, evicted):
+    parts = []
+
+    for owner, sizes in owners.items():
+        size = sum(sizes.values())
+        detail = [f"{name} {part / MB:.1f}" for name, part in sizes.items() if part >= MB / 10]
+
+        if size and len(sizes) > 1 and detail:
+            parts.append(f"{owner} {size / MB:.1f} [{', '.join(detail)}]")  # A state, split by the entity holding it
+        elif size:
+            parts.append(f"{owner} {size / MB:.1f}")
+
+    line = f"memory after entering {state_id}: {total(owners) / MB:.1f} MB ({', '.join(parts)})"
+
+    if evicted:
+        line += f", evicted {', '.join(evicted)}"
+
+    return line
@@ -0,0 +1,136 @@
+import pygame
+import numpy as np
+
+
+# Neighbour offsets as (dy, dx), orthogonal first so a diagonal only wins when it is strictly closer
+OFFSETS = [(-1, 0), (1, 0), (0, -1), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1)]
+
+OPEN = -1  # Flood states of a cell before it is reached, distances count up from 0
+CLOSED = -2
+
+CELL = 16
+FOOTPRINT = (40, 40)  # A ghost's size, what has to fit for a cell to be open
+
+
+def walkable(mask, cell=CELL, size=FOOTPRINT, rows=None):
+    # Open when a ghost with its top-left on the cell's corner touches nothing solid
+    footprint = pygame.mask.Mask(size, fill=True)
+    w, h = mask.get_size()
+    rows = range(h // cell) if rows is None else rows
+
+    return np.array([[not mask.overlap(footprint, (c * cell, r * cell)) for c in range(w // cell)] for r in rows], dtype=bool).reshape(len(rows), w // cell)
+
+
+def stack(grids, mask, height, cell=CELL, size=FOOTPRINT):
+    # Grids of bands of the same height, top to bottom, as the grid of their merged mask
+    if height % cell:
+        raise ValueError("stacked bands need a height that is a whole number of cells")
+
+    grid = np.concatenate(grids)
+    band = height // cell
+
+    for seam in range(band, len(grid), band):
+        rows = [row for row in range(seam) if row * cell + size[1] > seam * cell]  # Footprints reaching into the band below
+        grid[rows] = walkable(mask, cell, size, rows)
+
+    return grid
+
+
+class FlowField:
+    # Breadth-first distances to the player over a coarse grid of the stage mask, shared by every ghost
+    def __init__(self, mask, top=0, cell=CELL, size=FOOTPRINT, grid=None):
+        self.mask = mask
+        self.top = top  # World y of the mask's first row, a chunked stage only maps a window of the tower
+        self.cell = cell
+        self.size = size
+
+        w, h = mask.get_size()
+        self.shape = (h // cell, w // cell)
+
+        self.grid = grid  # Open cells when the stage has them precomputed, otherwise tested against the mask on first use
+        self.walkable = None  # Padded with a closed border, built on first use so stages without pathing ghosts never pay
+        self.blank = None
+        self.goal = None
+
+        self.steer = None
+        self.direct = None
+
+    def build(self):
+        rows, cols = self.shape
+
+        self.walkable = np.zeros((rows + 2, cols + 2), dtype=bool)
+        self.walkable[1:-1, 1:-1] = self.grid if self.grid is not None else walkable(self.mask, self.cell, self.size)
+        self.blank = np.where(self.walkable, OPEN, CLOSED).ravel().tolist()
+
+    def aim(self, pos):
+        x, y = pos
+        rows, cols = self.shape
+        goal = (min(max((y - self.top) // self.cell, 0), rows - 1) + 1) * (cols + 2) + min(max(x // self.cell, 0), cols - 1) + 1
+
+        if goal == self.goal:
+            return False
+
+        if self.walkable is None:
+            self.build()
+
+        self.goal = goal
+        self.flood(goal)
+
+        return True
+
+    def flood(self, goal):
+        rows, cols = self.shape
+        stride = cols + 2
+
+        dist = self.blank[:]
+        dist[goal] = 0
+
+        frontier = [goal]
+        step = 0
+
+        while frontier:  # A few thousand cells walk faster as plain lists than as whole-grid numpy passes
+            step += 1
+            reached = []
+
+            for cell in frontier:
+                for n in (cell - stride, cell + stride, cell - 1, cell + 1):  # The closed border keeps these in bounds
+                    if dist[n] == OPEN:
+                        dist[n] = step
+                        reached.append(n)
+
+            frontier = reached
+
+        dist = np.array(dist, dtype=float).reshape(rows + 2, cols + 2)
+        dist[dist < 0] = np.inf
+
+        candidates = []
+
+        for dy, dx in OFFSETS:
+            near = dist[1 + dy:1 + dy + rows, 1 + dx:1 + dx + cols]
+
+            if dy and dx:  # No cutting a corner a ghost would scrape
+                clear = self.walkable[1 + dy:1 + dy + rows, 1:1 + cols] & self.walkable[1:1 + rows, 1 + dx:1 + dx + cols]
+                near = np.where(clear, near, np.inf)
+
+            candidates.append(near)
+
+        candidates = np.array(candidates)
+        offsets = np.array(OFFSETS)[candidates.argmin(axis=0)]
+        r, c = np.indices(self.shape)
+
+        self.steer = np.array([(c + offsets[..., 1]) * self.cell, (r + offsets[..., 0]) * self.cell + self.top])
+        self.direct = (dist[1:-1, 1:-1] == 0) | np.isinf(candidates.min(axis=0))  # The goal's own cell, or walled off from it
+
+    def targets(self, points, goal):
+        # Where each point heads next, the corner of the next cell on its path or straight for the goal
+        x, y = points
+        cols = x // self.cell
+        rows = (y - self.top) // self.cell
+
+        inside = (cols >= 0) & (cols < self.shape[1]) & (rows >= 0) & (rows < self.shape[0])
+        rows = np.where(inside, rows, 0)
+        cols = np.where(inside, cols, 0)
+
+        direct = ~inside | self.direct[rows, cols]
+
+        return np.where(direct, np.array(goal)[:, None], self.steer[:, rows, cols])
@@ -0,0 +1,138 @@
+import pygame
+import csv
+import json
+import time
+from collections import defaultdict, deque
+
+
+class Scope:
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if self.profiler.enabled:
+            self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        if self.start is not None:
+            self.profiler.times[self.name] += time.perf_counter() - self.start
+            self.start = None
+
+
+class Profiler:
+    def __init__(self, history=3600):
+        self.enabled = False
+
+        self.records = deque(maxlen=history)  # Ring buffer of finished frames, oldest dropped first
+        self.times = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.scopes = {}
+
+        self.frame = 0
+        self.frame_start = time.perf_counter()
+
+        self.overlay = False
+        self.overlay_rect = pygame.Rect(8, 8, 260, 96)
+        self.backup = None
+        self.font = None
+
+    def scope(self, name):
+        if name not in self.scopes:
+            self.scopes[name] = Scope(self, name)
+
+        return self.scopes[name]
+
+    def count(self, name, amount=1):
+        if self.enabled:
+            self.counts[name] += amount
+
+    def begin_frame(self):
+        self.frame_start = time.perf_counter()
+
+    def end_frame(self, state_id):
+        if self.enabled:
+            record = {
+                "frame": self.frame,
+                "time": time.time(),
+                "state": state_id,
+                "frame_ms": (time.perf_counter() - self.frame_start) * 1000
+            }
+
+            record.update((name, elapsed * 1000) for name, elapsed in self.times.items())
+            record.update(self.counts)
+            self.records.append(record)
+
+        self.times.clear()
+        self.counts.clear()
+        self.frame += 1
+
+    def samples(self, name):
+        return [record.get(name, 0) for record in self.records]
+
+    def export(self, path):
+        records = list(self.records)
+
+        with open(path, "w", newline="") as f:
+            if path.endswith(".csv"):
+                fields = []
+
+                for record in records:
+                    fields.extend(name for name in record if name not in fields)
+
+                writer = csv.DictWriter(f, fields, restval=0)
+                writer.writeheader()
+                writer.writerows(records)
+
+            else:
+                for record in records:
+                    f.write(json.dumps(record) + "\n")
+
+    def toggle_overlay(self, screen):
+        self.overlay = not self.overlay
+        self.enabled = self.enabled or self.overlay
+
+        if not self.overlay:
+            return self.hide_overlay(screen)
+
+    def hide_overlay(self, screen):
+        if self.backup is not None:
+            screen.blit(self.backup, self.overlay_rect)
+            self.backup = None
+
+        return self.overlay_rect
+
+    def forget_overlay(self):
+        self.backup = None  # The screen underneath was replaced, e.g. by a state flip
+
+    def draw_overlay(self, screen):
+        rect = self.overlay_rect
+        self.backup = screen.subsurface(rect).copy()  # Whatever the state drew underneath, restored next frame
+
+        if self.font is None:
+            self.font = pygame.font.Font(None, 18)
+
+        frame_times = self.samples("frame_ms")[-rect.width:]
+        scale = (rect.height - 20) / 33.3  # Graph tops out at 30 FPS
+
+        screen.fill((20, 20, 20), rect)
+        budget = rect.bottom - 8.33 * scale
+        pygame.draw.line(screen, (90, 90, 90), (rect.left, budget), (rect.right - 1, budget))
+
+        points = [(rect.left + index, rect.bottom - 1 - min(ms * scale, rect.height - 20)) for index, ms in enumerate(frame_times)]
+
+        if len(points) > 1:
+            pygame.draw.lines(screen, (80, 220, 120), False, points)
+
+        if frame_times:
+            ordered = sorted(frame_times)
+            text = f"frame p50 {ordered[len(ordered) // 2]:.2f} ms  max {ordered[-1]:.2f} ms"
+            screen.blit(self.font.render(text, True, (230, 230, 230)), (rect.left + 4, rect.top + 4))
+
+        return rect
+
+
+profiler = Profiler()
@@ -0,0 +1,117 @@
+import pygame
+import struct
+
+
+MAGIC = b"TCRP"
+VERSION = 2  # 2: the menu starts the streamed tower instead of level1
+
+HEADER = struct.Struct("<4sHQB")  # Magic, version, seed, length of the start state id
+FRAME = struct.Struct("<dHB")  # Frame time added to the accumulator, held key bits, event count
+EVENT = struct.Struct("<BIhh")  # Event kind, key or mouse button, x, y
+
+TRACKED_KEYS = [pygame.K_LEFT, pygame.K_RIGHT, pygame.K_UP, pygame.K_DOWN, pygame.K_ESCAPE]
+
+EVENT_KINDS = [pygame.QUIT, pygame.KEYDOWN, pygame.KEYUP, pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP]
+
+
+class HeldKeys:
+    def __init__(self, held):
+        self.held = held
+
+    def __getitem__(self, key):
+        return key in self.held
+
+
+def pack_keys(keys):
+    return sum(1 << bit for bit, key in enumerate(TRACKED_KEYS) if keys[key])
+
+
+def unpack_keys(bits):
+    return HeldKeys({key for bit, key in enumerate(TRACKED_KEYS) if bits & 1 << bit})
+
+
+def pack_event(event):
+    kind = EVENT_KINDS.index(event.type)
+
+    if event.type in (pygame.KEYDOWN, pygame.KEYUP):
+        return EVENT.pack(kind, event.key, 0, 0)
+
+    if event.type in (pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP):
+        return EVENT.pack(kind, event.button, *event.pos)
+
+    return EVENT.pack(kind, 0, 0, 0)
+
+
+def unpack_event(data, offset):
+    kind, code, x, y = EVENT.unpack_from(data, offset)
+    event_type = EVENT_KINDS[kind]
+
+    if event_type in (pygame.KEYDOWN, pygame.KEYUP):
+        return pygame.event.Event(event_type, key=code)
+
+    if event_type in (pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP):
+        return pygame.event.Event(event_type, button=code, pos=(x, y))
+
+    return pygame.event.Event(event_type)
+
+
+class Recorder:
+    def __init__(self, path, start_state, seed):
+        state = start_state.encode()
+
+        self.file = open(path, "wb")
+        self.file.write(HEADER.pack(MAGIC, VERSION, seed, len(state)) + state)
+
+        self.keys = 0
+        self.events = []
+
+    def input(self, events, keys):
+        self.keys = pack_keys(keys)
+        self.events = [pack_event(event) for event in events if event.type in EVENT_KINDS]
+
+    def end_frame(self, frame_time):
+        self.file.write(FRAME.pack(frame_time, self.keys, len(self.events)) + b"".join(self.events))
+
+    def close(self):
+        self.file.close()
+
+
+def read(path):
+    with open(path, "rb") as f:
+        data = f.read()
+
+    magic, version, seed, length = HEADER.unpack_from(data)
+
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a version {VERSION} replay log")
+
+    offset = HEADER.size
+    start_state = data[offset:offset + length].decode()
+    offset += length
+
+    frames = []
+
+    while offset < len(data):
+        frame_time, keys, count = FRAME.unpack_from(data, offset)
+        offset += FRAME.size
+
+        events = []
+
+        for _ in range(count):
+            events.append(unpack_event(data, offset))
+            offset += EVENT.size
+
+        frames.append((frame_time, unpack_keys(keys), events))
+
+    return start_state, seed, frames
+
+
+def summary(control):
+    state = control.state
+    result = {"state": state.id}
+
+    if getattr(state, "player", None) is not None:
+        result["player"] = tuple(state.player.rect)
+        result["ghosts"] = list(zip(state.ghosts.x.tolist(), state.ghosts.y.tolist()))
+
+    return result
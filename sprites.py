@@ -1,4 +1,24 @@
+import pygame
 from tools import SpriteGroup
 
-player = SpriteGroup("sprites/player", "dino", 0.25, (45, 51))
-confetti = SpriteGroup("sprites/win", "win", 0.032, (1080, 1920), "main", False)
+
+SCREEN = "screen"  # Stands for the display's logical size, known only once it is open
+
+SPECS = {
+    "player": (("sprites/player", "dino", 0.25, (45, 51)), {}),
+    "confetti": (("sprites/win", "win", 0.032, (1080, 1920), False), {"lazy": True, "collide": False, "clip": SCREEN})
+}
+
+groups = {}  # Built on first use, the menu needs none of them
+
+
+def get(name):
+    if name not in groups:
+        args, kwargs = SPECS[name]
+
+        if kwargs.get("clip") == SCREEN:
+            kwargs = dict(kwargs, clip=pygame.display.get_surface().get_size())  # Each frame is scaled once, straight to what the window shows
+
+        groups[name] = SpriteGroup(*args, **kwargs)
+
+    return groups[name]
@@ -1,7 +1,17 @@
 import pygame
-from entities import Player, Ghost
+from assets import registry
+from entities import Player, GhostSwarm
+import math
 import random
-from sprites import confetti
+import sprites
+from profiler import profiler
+from levels import pack
+from tools import Animation, RunTable
+import pathing
+from pathing import FlowField
+
+
+rng = random.Random()  # Seeded by Control so recorded sessions replay identically
 
 
 def mask_collide(mask, rect, x, y):
@@ -9,17 +19,124 @@ def mask_collide(mask, rect, x, y):
 
 
 class Stage:
-    def __init__(self, file):
-        self.image = pygame.image.load(f"sprites/{file}.png").convert_alpha()
-        self.mask = pygame.image.load(f"sprites/{file}_mask.png")
-        self.mask.set_colorkey((255, 255, 255))
-        self.mask = pygame.mask.from_surface(self.mask.convert_alpha())
+    def __init__(self, level_id):
+        self.level = pack.get(level_id)  # Held for as long as the stage lives so every stage of this level shares it
+        self.image = self.level.image
+        self.mask = self.level.mask
+        self.runs = self.level.runs  # Per-row/column solid spans for O(runs) collision response
+        self.width = self.image.get_width()
+        self.field = FlowField(self.mask, grid=self.level.walkable)  # Shared by every pathing ghost, flooded the first time one asks
+
+    @staticmethod
+    def preload(level_id):
+        pack.prefetch(level_id)  # Ignores ids that are not levels, e.g. the victory screen
+
+    def overlap(self, mask, pos):
+        return self.mask.overlap(mask, pos)
+
+    def sweep(self, rect, dx, dy):
+        return self.runs.sweep(rect, dx, dy)
+
+    def resolve(self, rect, dx, dy):
+        return self.runs.resolve(rect, dx, dy)
+
+    def draw(self, screen, area=None):
+        if area is None:
+            screen.blit(self.image, (0, 0))
+        else:
+            screen.blit(self.image, area, area)  # Restore only the damaged part of the background
+
+
+class ChunkedStage:
+    def __init__(self, level_ids):
+        sizes = {tuple(pack.levels[level_id]["size"]) for level_id in level_ids}
+
+        if len(sizes) != 1:
+            raise ValueError("every level stacked into a tower needs the same size")
+
+        self.ids = level_ids  # Top to bottom, chunk i covers world rows [i * chunk_height, (i + 1) * chunk_height)
+        self.width, self.chunk_height = sizes.pop()
+        self.height = self.chunk_height * len(level_ids)
+
+        self.chunks = {}  # Only the chunks around the camera, the pack keeps a few more decoded
+
+        self.window = None  # The two chunks around the player merged, collision never looks further
+        self.top = 0
+        self.mask = None
+        self.runs = None
+        self.field = None
+
+    def indices(self, top, bottom):
+        return range(max(top // self.chunk_height, 0), min((bottom - 1) // self.chunk_height + 1, len(self.ids)))
+
+    def chunk(self, index):
+        if index not in self.chunks:
+            self.chunks[index] = pack.get(self.ids[index])
+
+        return self.chunks[index]
+
+    def stream(self, top, bottom, prefetch=True):
+        margin = self.chunk_height // 2
+        wanted = self.indices(top - margin, bottom + margin)
 
-    def draw(self, screen):
-        screen.blit(self.image, (0, 0))
+        for index in list(self.chunks):
+            if index not in wanted:
+                del self.chunks[index]
+
+        for index in wanted:
+            self.chunk(index)
+
+        for index in (wanted.start - 1, wanted.stop) if prefetch else ():
+            if 0 <= index < len(self.ids):
+                pack.prefetch(self.ids[index])  # Decoded on a worker thread before the camera gets there
+
+        return wanted
+
+    def focus(self, rect):
+        index = (rect.centery - self.chunk_height // 2) // self.chunk_height
+        index = max(min(index, len(self.ids) - 2), 0)
+
+        if index == self.window:
+            return False
+
+        chunks = [self.chunk(band) for band in range(index, min(index + 2, len(self.ids)))]
+
+        self.window = index
+        self.top = index * self.chunk_height
+        self.mask = pygame.mask.Mask((self.width, self.chunk_height * len(chunks)))
+        self.runs = RunTable.stack([chunk.runs for chunk in chunks], self.chunk_height)
+
+        for band, chunk in enumerate(chunks):
+            self.mask.draw(chunk.mask, (0, band * self.chunk_height))
+
+        grid = pathing.stack([chunk.walkable for chunk in chunks], self.mask, self.chunk_height)
+        self.field = FlowField(self.mask, self.top, grid=grid)  # Ghosts outside the window fly straight at the player
+
+        return True
+
+    def overlap(self, mask, pos):
+        x, y = pos
+        return self.mask.overlap(mask, (x, y - self.top))
+
+    def sweep(self, rect, dx, dy):
+        return self.runs.sweep(rect.move(0, -self.top), dx, dy)
+
+    def resolve(self, rect, dx, dy):
+        return self.runs.resolve(rect.move(0, -self.top), dx, dy)
+
+    def draw(self, screen, camera, area=None):
+        screen.set_clip(area)  # Blits are clipped by SDL, only the damaged part is copied
+
+        for index in self.indices(camera, camera + screen.get_height()):
+            screen.blit(self.chunk(index).image, (0, index * self.chunk_height - camera))
+
+        screen.set_clip(None)
 
 
 class State:
+    reusable = False  # Kept by Control after it is dismissed and brought back with restore()
+    frame_rate = None  # Renders it needs per second, None for as many as Control allows, 0 when only input changes it
+
     def __init__(self, state_id):
         self.id = state_id
 
@@ -30,18 +147,39 @@ class State:
         self.next_args = []
         self.next_kwargs = {}
 
+        self.crossed = None  # Floor entered without a flip, --frame-stats times that frame like a transition
+        self.redraw = True  # Whole screen has to be presented, otherwise only update_rects
+        self.update_rects = []
+
+        self.assets = []
+
+    def load(self, path):
+        asset = registry.acquire(path)
+        self.assets.append(asset)
+
+        return asset.image, asset.mask
+
     def get_event(self, event):
         pass
 
     def get_keys(self, keys):
         pass
 
-    def update(self, screen, dt):
+    def update(self, dt):
+        pass
+
+    def draw(self, screen, alpha):
         pass
 
     def startup(self, screen):
         pass
 
+    def snapshot(self):
+        return None
+
+    def restore(self, snapshot):
+        pass
+
     def restart(self, *args, **kwargs):
         self.done = False
         self.next = None
@@ -50,22 +188,35 @@ class State:
         self.next_args = []
         self.next_kwargs = {}
 
+        self.redraw = True
+
     def destroy(self):
-        pass
+        for asset in self.assets:
+            registry.release(asset)
+
+        self.assets.clear()
 
 
 class Level(State):
+    preload_next = True
+    reusable = True
+
     def __init__(self, state_id):
         super().__init__(state_id)
 
         self.player = None
         self.stage = None
         self.ghosts = None
+        self.initial = None
 
-        self.start_pos = None
-        self.next_state = None
-        self.is_first = None
-        self.ghost_list = None
+        spec = pack.levels[state_id]
+
+        self.start_pos = tuple(spec["start"])
+        self.next_state = spec["next"]
+        self.is_first = spec["first"]
+        self.ghost_list = [tuple(ghost) for ghost in spec["ghosts"]]
+
+        self.drawn_rects = []
 
     def get_event(self, event):
         if event.type == pygame.KEYDOWN:
@@ -82,13 +233,24 @@ class Level(State):
     def startup(self, screen):
         self.player = Player(*self.start_pos)
         self.stage = Stage(self.id)
-        self.ghosts = []
+        self.ghosts = GhostSwarm(self.ghost_list)
+
+        if self.preload_next:
+            Stage.preload(self.next_state)  # Decoded on a worker thread while this level is played
 
-        for ghost in self.ghost_list:
-            self.ghosts.append(Ghost(*ghost))
+        self.initial = self.snapshot()
 
         screen.fill((255, 255, 255))
 
+    def snapshot(self):
+        return self.player.snapshot(), self.ghosts.snapshot()
+
+    def restore(self, snapshot):
+        player, ghosts = snapshot
+
+        self.player.restore(player)
+        self.ghosts.restore(ghosts)
+
     def restart(self, *args, **kwargs):
         if len(args) == 3:
             x, vy, dunked = args
@@ -96,24 +258,35 @@ class Level(State):
             self.player.rect.x = x
             self.player.vy = vy
             self.player.dunked = dunked
+            self.player.settle()
+            self.player.set_pose()
 
-            self.player.set_sprite_rules()
+            for index in range(len(self.ghosts)):
+                self.ghosts.x[index] = rng.randint(0, self.stage.image.get_width())
+                self.ghosts.y[index] = rng.randint(0, self.stage.image.get_height())
 
-            for ghost in self.ghosts:
-                ghost.x = random.randint(0, self.stage.image.get_width())
-                ghost.y = random.randint(0, self.stage.image.get_height())
+            self.ghosts.settle()
 
         super().restart()
 
-    def update(self, screen, dt):
-        self.player.update(self.stage, dt)
+    def destroy(self):
+        self.ghosts.destroy()
 
-        for ghost in self.ghosts:
-            ghost.update(self.player, dt)
+        super().destroy()
 
-            if ghost.check_collision(self.player):
-                self.done = True
-                self.next = "menu"
+    def update(self, dt):
+        with profiler.scope("Player.update"):
+            self.player.update(self.stage, dt)
+
+        with profiler.scope("GhostSwarm.update"):
+            self.ghosts.update(self.player, dt, self.stage.field)
+
+        with profiler.scope("GhostSwarm.check_collision"):
+            caught = self.ghosts.check_collision(self.player)
+
+        if caught:
+            self.done = True
+            self.next = "menu"
 
         if self.player.rect.y < 0:
             self.player.rect.y = 0
@@ -127,70 +300,173 @@ class Level(State):
             self.next_args = [self.player.rect.x, self.player.vy, self.player.dunked]
             self.done = True
 
-        self.stage.draw(screen)
-        self.player.draw(screen)
-
-        for ghost in self.ghosts:
-            ghost.draw(screen)
-
-
-class Level1(Level):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
-        self.start_pos = (580, 734)
-        self.next_state = "level2"
-        self.is_first = True
-        self.ghost_list = [
-            (500, 100, "orange")
-        ]
-
-class Level2(Level):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
-        self.start_pos = (100, 614)
-        self.next_state = "level3"
-        self.is_first = False
-        self.ghost_list = [
-            (500, 100, "orange")
-        ]
-
-class Level3(Level):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
-        self.start_pos = (100, 614)
-        self.next_state = "level4"
-        self.is_first = False
-        self.ghost_list = [
-            (500, 100, "orange")
-        ]
-
-class Level4(Level):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
-        self.start_pos = (100, 614)
-        self.next_state = "level5"
-        self.is_first = False
-        self.ghost_list = [
-            (500, 100, "orange")
-        ]
-
-class Level5(Level):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
-        self.start_pos = (50, 764)
-        self.next_state = "win"
-        self.is_first = False
-        self.ghost_list = [
-            (800, 750, "orange")
-        ]
+    def draw(self, screen, alpha):
+        with profiler.scope("draw.stage"):
+            if self.redraw:
+                self.stage.draw(screen)
+            else:
+                for rect in self.drawn_rects:
+                    self.stage.draw(screen, rect)
+
+        self.update_rects.extend(self.drawn_rects)
+
+        with profiler.scope("draw.player"):
+            self.drawn_rects = [self.player.draw(screen, alpha)]
+
+        with profiler.scope("draw.ghosts"):
+            self.drawn_rects.extend(self.ghosts.draw(screen, alpha))
+
+        self.update_rects.extend(self.drawn_rects)
+
+
+class Tower(State):
+    preload_next = True
+    reusable = True
+
+    def __init__(self, state_id):
+        super().__init__(state_id)
+
+        self.player = None
+        self.stage = None
+        self.ghosts = None
+        self.initial = None
+
+        self.next_state = None
+        self.spawned = set()
+
+        self.view_height = None
+        self.camera = 0  # World row at the top of the screen
+        self.prev_camera = 0
+        self.drawn_camera = None
+
+        self.drawn_rects = []
+
+    def get_event(self, event):
+        if event.type == pygame.KEYDOWN:
+            if event.key == pygame.K_ESCAPE:
+                self.next = "pause"
+                self.preserve = True
+                self.done = True
+
+            self.player.get_event(event)
+
+    def get_keys(self, keys):
+        self.player.get_keys(keys)
+
+    def startup(self, screen):
+        climb = [pack.ids[0]]  # Follow the links up from the first floor
+
+        while pack.levels[climb[-1]]["next"] in pack and pack.levels[climb[-1]]["next"] not in climb:
+            climb.append(pack.levels[climb[-1]]["next"])
+
+        self.stage = ChunkedStage(climb[::-1])
+        self.next_state = pack.levels[climb[-1]]["next"]
+
+        x, y = pack.levels[climb[0]]["start"]
+        self.player = Player(x, y + self.stage.height - self.stage.chunk_height)
+        self.ghosts = GhostSwarm([])
+
+        self.view_height = screen.get_height()
+        self.follow()
+        self.prev_camera = self.camera
+        self.stream()
+
+        self.initial = self.snapshot()
+
+        screen.fill((255, 255, 255))
+
+    def snapshot(self):
+        return self.player.snapshot(), self.ghosts.snapshot(), self.camera, frozenset(self.spawned)
+
+    def restore(self, snapshot):
+        player, ghosts, self.camera, spawned = snapshot
+
+        self.player.restore(player)
+        self.ghosts.restore(ghosts)
+
+        self.prev_camera = self.camera
+        self.drawn_camera = None
+        self.spawned = set(spawned)
+
+    def follow(self):
+        self.camera = max(min(self.player.rect.centery - self.view_height // 2, self.stage.height - self.view_height), 0)
+
+    def stream(self):
+        wanted = self.stage.stream(self.camera, self.camera + self.view_height, self.preload_next)
+
+        for index in sorted(self.spawned.difference(wanted)):
+            self.spawned.discard(index)
+            self.ghosts.despawn(index)  # Leave with their floor, the swarm never grows with the tower
+
+        for index in wanted:
+            if index in self.spawned:
+                continue
+
+            self.spawned.add(index)  # Spawned fresh from the pack whenever the floor streams in
+            top = index * self.stage.chunk_height
+            self.ghosts.spawn([(x, y + top) + tuple(rest) for x, y, *rest in pack.levels[self.stage.ids[index]]["ghosts"]], index)
+
+    def destroy(self):
+        self.ghosts.destroy()
+        super().destroy()
+
+    def update(self, dt):
+        self.prev_camera = self.camera
+
+        if self.stage.focus(self.player.rect):
+            self.crossed = self.stage.ids[min(max(self.player.rect.centery // self.stage.chunk_height, 0), len(self.stage.ids) - 1)]
+
+        with profiler.scope("Player.update"):
+            self.player.update(self.stage, dt)
+
+        with profiler.scope("GhostSwarm.update"):
+            self.ghosts.update(self.player, dt, self.stage.field)
+
+        with profiler.scope("GhostSwarm.check_collision"):
+            caught = self.ghosts.check_collision(self.player)
+
+        if caught:
+            self.done = True
+            self.next = "menu"
+
+        if self.player.rect.y < 0:  # Climbed out of the top floor
+            self.player.rect.y = 0
+            self.player.vy = 0
+
+            self.next = self.next_state
+            self.done = True
+
+        self.follow()
+        self.stream()
+
+    def draw(self, screen, alpha):
+        camera = int(self.prev_camera + (self.camera - self.prev_camera) * alpha)
+
+        if camera != self.drawn_camera:
+            self.redraw = True  # Scrolling moves every pixel on screen
+            self.drawn_camera = camera
+
+        with profiler.scope("draw.stage"):
+            if self.redraw:
+                self.stage.draw(screen, camera)
+            else:
+                for rect in self.drawn_rects:
+                    self.stage.draw(screen, camera, rect)
+
+        self.update_rects.extend(self.drawn_rects)
+
+        with profiler.scope("draw.player"):
+            self.drawn_rects = [self.player.draw(screen, alpha, camera)]
+
+        with profiler.scope("draw.ghosts"):
+            self.drawn_rects.extend(self.ghosts.draw(screen, alpha, camera))
+
+        self.update_rects.extend(self.drawn_rects)
 
 
 class Menu(State):
+    frame_rate = 0
+
     def __init__(self, state_id):
         super().__init__(state_id)
 
@@ -205,12 +481,10 @@ class Menu(State):
     def startup(self, screen):
         w, h = screen.get_size()
 
-        self.start_button = pygame.image.load("sprites/start_button.png").convert_alpha()
-        self.start_mask = pygame.mask.from_surface(self.start_button)
+        self.start_button, self.start_mask = self.load("sprites/start_button.png")
         self.start_rect = self.start_button.get_rect(center=(w // 2, h // 2 - 50))
 
-        self.exit_button = pygame.image.load("sprites/exit_button.png").convert_alpha()
-        self.exit_mask = pygame.mask.from_surface(self.exit_button)
+        self.exit_button, self.exit_mask = self.load("sprites/exit_button.png")
         self.exit_rect = self.exit_button.get_rect(center=(w // 2, h // 2 + 50))
 
         screen.fill((255, 255, 255))
@@ -223,10 +497,10 @@ class Menu(State):
             self.quit = True
 
         if event.type == pygame.MOUSEBUTTONUP and event.button == 1:
-            x, y = pygame.mouse.get_pos()
+            x, y = event.pos
 
             if mask_collide(self.start_mask, self.start_rect, x, y):
-                self.next = "level1"
+                self.next = "tower"
                 self.done = True
 
             elif mask_collide(self.exit_mask, self.exit_rect, x, y):
@@ -234,6 +508,8 @@ class Menu(State):
 
 
 class Pause(State):
+    frame_rate = 0
+
     def __init__(self, state_id):
         super().__init__(state_id)
         self.resume_button = None
@@ -255,20 +531,16 @@ class Pause(State):
     def startup(self, screen):
         w, h = screen.get_size()
 
-        self.resume_button = pygame.image.load("sprites/resume_button.png").convert_alpha()
-        self.resume_mask = pygame.mask.from_surface(self.resume_button)
+        self.resume_button, self.resume_mask = self.load("sprites/resume_button.png")
         self.resume_rect = self.resume_button.get_rect(center=(w // 2, h // 2 - 150))
 
-        self.restart_button = pygame.image.load("sprites/restart_button.png").convert_alpha()
-        self.restart_mask = pygame.mask.from_surface(self.restart_button)
+        self.restart_button, self.restart_mask = self.load("sprites/restart_button.png")
         self.restart_rect = self.restart_button.get_rect(center=(w // 2, h // 2 - 50))
 
-        self.menu_button = pygame.image.load("sprites/menu_button.png").convert_alpha()
-        self.menu_mask = pygame.mask.from_surface(self.menu_button)
+        self.menu_button, self.menu_mask = self.load("sprites/menu_button.png")
         self.menu_rect = self.menu_button.get_rect(center=(w // 2, h // 2 + 50))
 
-        self.exit_button = pygame.image.load("sprites/exit_button.png").convert_alpha()
-        self.exit_mask = pygame.mask.from_surface(self.exit_button)
+        self.exit_button, self.exit_mask = self.load("sprites/exit_button.png")
         self.exit_rect = self.exit_button.get_rect(center=(w // 2, h // 2 + 150))
 
         screen.blit(self.resume_button, self.resume_rect)
@@ -281,13 +553,13 @@ class Pause(State):
             self.done = True
 
         if event.type == pygame.MOUSEBUTTONUP and event.button == 1:
-            x, y = pygame.mouse.get_pos()
+            x, y = event.pos
 
             if mask_collide(self.resume_mask, self.resume_rect, x, y):
                 self.done = True
 
             elif mask_collide(self.restart_mask, self.restart_rect, x, y):
-                self.next = "level1"
+                self.next = "tower"
                 self.done = True
 
             elif mask_collide(self.menu_mask, self.menu_rect, x, y):
@@ -302,7 +574,8 @@ class Victory(State):
     def __init__(self, state_id):
         super().__init__(state_id)
 
-        self.confetti = confetti
+        self.confetti = Animation(sprites.get("confetti"), "main")
+        self.frame_rate = math.ceil(1 / self.confetti.frames.dt)  # Rendering faster than the confetti animates shows nothing new, slower skips frames
 
         self.title = None
         self.title_rect = None
@@ -326,19 +599,16 @@ class Victory(State):
 
         self.background = screen.copy()
 
-        self.title = pygame.image.load("sprites/victory.png").convert_alpha()
+        self.title, _ = self.load("sprites/victory.png")
         self.title_rect = self.title.get_rect(center=(w // 2, h // 2 - 200))
 
-        self.restart_button = pygame.image.load("sprites/restart_button.png").convert_alpha()
-        self.restart_mask = pygame.mask.from_surface(self.restart_button)
+        self.restart_button, self.restart_mask = self.load("sprites/restart_button.png")
         self.restart_rect = self.restart_button.get_rect(center=(w // 2, h // 2 - 50))
 
-        self.menu_button = pygame.image.load("sprites/menu_button.png").convert_alpha()
-        self.menu_mask = pygame.mask.from_surface(self.menu_button)
+        self.menu_button, self.menu_mask = self.load("sprites/menu_button.png")
         self.menu_rect = self.menu_button.get_rect(center=(w // 2, h // 2 + 50))
 
-        self.exit_button = pygame.image.load("sprites/exit_button.png").convert_alpha()
-        self.exit_mask = pygame.mask.from_surface(self.exit_button)
+        self.exit_button, self.exit_mask = self.load("sprites/exit_button.png")
         self.exit_rect = self.exit_button.get_rect(center=(w // 2, h // 2 + 150))
 
     def get_event(self, event):
@@ -346,10 +616,10 @@ class Victory(State):
             self.done = True
 
         if event.type == pygame.MOUSEBUTTONUP and event.button == 1:
-            x, y = pygame.mouse.get_pos()
+            x, y = event.pos
 
             if mask_collide(self.restart_mask, self.restart_rect, x, y):
-                self.next = "level1"
+                self.next = "tower"
                 self.done = True
 
             elif mask_collide(self.menu_mask, self.menu_rect, x, y):
@@ -359,11 +629,16 @@ class Victory(State):
             elif mask_collide(self.exit_mask, self.exit_rect, x, y):
                 self.quit = True
 
-    def update(self, screen, dt):
+    def update(self, dt):
         self.confetti.tick(dt)
 
+    def draw(self, screen, alpha):
+        self.redraw = True  # Confetti covers the whole screen every frame
+
         screen.blit(self.background, (0, 0))
-        screen.blit(self.confetti.sprite, (0, 0))
+
+        with profiler.scope("draw.confetti"):
+            screen.blit(self.confetti.sprite, (0, 0))
 
         screen.blit(self.title, self.title_rect)
         screen.blit(self.restart_button, self.restart_rect)
@@ -0,0 +1,14 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.chdir(ROOT)  # Sprite and level paths are relative to the repo
+sys.path.insert(0, ROOT)
+
+import pygame
+
+pygame.init()
+pygame.display.set_mode((1, 1))  # Loaders convert to the display format
@@ -0,0 +1,77 @@
+import numpy as np
+import pygame
+import main
+from levels import pack
+
+
+TICK = 1 / 120
+
+
+def press(control, key):
+    control.state.get_event(pygame.event.Event(pygame.KEYDOWN, key=key))
+    control.update(TICK)
+
+
+def climb(control, floors):
+    # Drop the player on each floor's start in turn, as if it had climbed there
+    tower = control.state
+
+    for floor in range(1, floors + 1):
+        index = len(tower.stage.ids) - 1 - floor
+        x, y = pack.levels[tower.stage.ids[index]]["start"]
+
+        tower.player.rect.topleft = (x, y + index * tower.stage.chunk_height)
+        tower.player.vy = 0
+
+        for _ in range(10):
+            control.update(TICK)
+
+    assert control.state is tower
+
+
+def test_tower_rebuilt_from_its_snapshot_keeps_its_ghosts():
+    control = main.Control("tower", seed=1)
+    climb(control, 3)
+
+    tower = control.state
+    snapshot = tower.snapshot()
+    control.park(tower)
+    control.pool.pop("tower").destroy()  # Evicted while backlogged, only the snapshot is left
+
+    rebuilt = control.summon("tower", snapshot)
+    assert rebuilt is not tower
+
+    for name in ("colors", "pathing", "pos", "vel", "direction"):
+        assert np.array_equal(getattr(rebuilt.ghosts, name), getattr(tower.ghosts, name)), name
+
+    assert rebuilt.spawned == tower.spawned
+    assert set(rebuilt.ghosts.masks) == set(rebuilt.ghosts.colors)
+
+    control.state = rebuilt
+
+    for _ in range(120):
+        control.update(TICK)
+        assert len(rebuilt.ghosts.colors) == rebuilt.ghosts.pos.shape[1]
+
+
+def test_budget_pause_and_resume_after_climbing():
+    runs = []
+
+    for budget in (None, 1):
+        control = main.Control("tower", seed=1, memory_budget=budget)
+        climb(control, 3)
+        tower = control.state
+
+        press(control, pygame.K_ESCAPE)
+        assert control.state.id == "pause"
+        assert not any("tower" in step for _, _, evicted in control.memory_log for step in evicted)
+
+        press(control, pygame.K_ESCAPE)
+        assert control.state is tower
+
+        for _ in range(120):
+            control.update(TICK)
+
+        runs.append((tuple(tower.player.rect), tower.ghosts.colors, tower.ghosts.pos.tolist()))
+
+    assert runs[0] == runs[1]
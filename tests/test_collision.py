@@ -0,0 +1,147 @@
+import pygame
+import pytest
+from cache import mask_from_bytes
+from entities import Player
+from levels import read_manifest, solid_pixels
+from tools import RunTable
+
+
+DTS = (0.05, 0.3, 1.0)
+GRID = 72  # Spacing of the start points across each level
+FRAMES = 40
+SIZE = (45, 51)  # The player's rect
+
+
+class Ground:
+    # What Player.update asks of a stage, backed by one level's mask
+    def __init__(self, mask):
+        self.mask = mask
+        self.runs = RunTable(mask)
+        self.width = mask.get_size()[0]
+
+    def overlap(self, mask, pos):
+        return self.mask.overlap(mask, pos)
+
+    def sweep(self, rect, dx, dy):
+        return self.runs.sweep(rect, dx, dy)
+
+    def resolve(self, rect, dx, dy):
+        return self.runs.resolve(rect, dx, dy)
+
+
+def load(spec):
+    solid = solid_pixels(spec["mask"])
+    h, w = solid.shape
+
+    return Ground(mask_from_bytes(solid.astype("uint8").tobytes(), (w, h)))
+
+
+LEVELS = {spec["id"]: spec for spec in read_manifest()}
+GROUNDS = {}
+
+
+@pytest.fixture(params=sorted(LEVELS))
+def ground(request):
+    if request.param not in GROUNDS:
+        GROUNDS[request.param] = load(LEVELS[request.param])
+
+    return GROUNDS[request.param]
+
+
+BODY = pygame.mask.Mask(SIZE, fill=True)
+
+
+def hits(ground, rect, dx=0, dy=0):
+    return bool(ground.mask.overlap(BODY, (rect.x + dx, rect.y + dy)))
+
+
+def walk_sweep(ground, rect, dx, dy):
+    # Pixel by pixel until the next step would touch the mask
+    distance = dx or dy
+    step = 1 if distance > 0 else -1
+    moved = 0
+
+    while moved != distance and not hits(ground, rect, (moved + step) * bool(dx), (moved + step) * bool(dy)):
+        moved += step
+
+    return moved
+
+
+def walk_resolve(ground, rect, dx, dy):
+    # Pixel by pixel until the rect is clear
+    direction = dx or dy
+    shift = 0
+
+    while hits(ground, rect, shift * bool(dx), shift * bool(dy)):
+        shift += direction
+
+    return shift
+
+
+def starts(ground, clear):
+    w, h = ground.mask.get_size()
+
+    for x in range(0, w - SIZE[0], GRID):
+        for y in range(0, h - SIZE[1], GRID):
+            rect = pygame.Rect((x, y), SIZE)
+
+            if hits(ground, rect) != clear:
+                yield rect
+
+
+def distances(dt):
+    # Walking, a full jump and a dunk, at the step each one takes in a tick of dt
+    return [int(speed * dt * 125) for speed in (3, 6.5, 10)]
+
+
+@pytest.mark.parametrize("dt", DTS)
+def test_sweep_matches_pixel_walk(ground, dt):
+    for rect in starts(ground, clear=True):
+        for distance in distances(dt):
+            for dx, dy in ((distance, 0), (-distance, 0), (0, distance), (0, -distance)):
+                assert ground.sweep(rect, dx, dy) == walk_sweep(ground, rect, dx, dy), (rect, dx, dy)
+
+
+def test_resolve_matches_pixel_walk(ground):
+    for rect in starts(ground, clear=False):
+        for dx, dy in ((1, 0), (-1, 0), (0, 1), (0, -1)):
+            assert ground.resolve(rect, dx, dy) == walk_resolve(ground, rect, dx, dy), (rect, dx, dy)
+
+
+def path_clear(ground, before, after):
+    # Player.update moves along x first, then along y from where that left it
+    x, y = before.topleft
+    dx, dy = after.x - x, after.y - y
+
+    for step in range(0, dx + (1 if dx >= 0 else -1), 1 if dx >= 0 else -1):
+        if hits(ground, pygame.Rect((x + step, y), SIZE)):
+            return False
+
+    for step in range(0, dy + (1 if dy >= 0 else -1), 1 if dy >= 0 else -1):
+        if hits(ground, pygame.Rect((after.x, y + step), SIZE)):
+            return False
+
+    return True
+
+
+@pytest.mark.parametrize("dt", DTS)
+@pytest.mark.parametrize("move", ["dunk", "left", "right"])
+def test_player_never_tunnels(ground, dt, move):
+    for rect in starts(ground, clear=True):
+        player = Player(*rect.topleft)
+
+        if move == "dunk":
+            player.dunk()
+        else:
+            player.vx = -3 if move == "left" else 3
+            player.set_pose()
+
+        for frame in range(FRAMES):
+            before = player.rect.copy()
+            player.update(ground, dt)
+
+            assert not player.check_collision(ground), (rect, frame)
+            assert path_clear(ground, before, player.rect), (rect, frame, before, player.rect)
+
+            if player.rect.top >= ground.mask.get_size()[1]:
+                break  # Fell out of the level, nothing left to hit
@@ -0,0 +1,37 @@
+import main
+from levels import pack
+
+
+TICK = 1 / 120
+
+
+def visit(tower, control, index):
+    x, y = pack.levels[tower.stage.ids[index]]["start"]
+    tower.player.rect.topleft = (x, y + index * tower.stage.chunk_height)
+    tower.player.vy = 0
+
+    for _ in range(10):
+        control.update(TICK)
+
+
+def floors_of(tower):
+    return sorted(set(tower.ghosts.groups.tolist()))
+
+
+def test_ghosts_leave_and_return_with_their_floor():
+    control = main.Control("tower", seed=1)
+    tower = control.state
+    bottom = len(tower.stage.ids) - 1
+    sizes = []
+
+    for index in list(range(bottom, -1, -1)) + list(range(bottom + 1)):  # Up the tower and back down
+        visit(tower, control, index)
+        assert control.state is tower
+
+        assert floors_of(tower) == sorted(tower.spawned) == sorted(tower.stage.chunks)
+        assert len(tower.ghosts) == sum(len(pack.levels[tower.stage.ids[floor]]["ghosts"]) for floor in tower.spawned)
+        assert len(tower.ghosts.colors) == tower.ghosts.pos.shape[1] == len(tower.ghosts.groups)
+
+        sizes.append(len(tower.ghosts))
+
+    assert max(sizes) <= 3 * max(len(level["ghosts"]) for level in pack.levels.values())  # The screen and half a floor either side
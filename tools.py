@@ -1,84 +1,360 @@
 import pygame
 import glob
 import os
+import re
+import cache
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Atlas:
+    def __init__(self, images, max_width=512):
+        self.rects = [None] * len(images)
+        x = y = shelf = 0
+
+        for index in sorted(range(len(images)), key=lambda i: -images[i].get_height()):  # Shelf packing, tallest first
+            w, h = images[index].get_size()
+
+            if x and x + w > max_width:
+                x, y, shelf = 0, y + shelf, 0
+
+            self.rects[index] = pygame.Rect(x, y, w, h)
+            x += -w % 4 + w  # Frames start on 16 byte boundaries, misaligned sources fall off pygame's SIMD blitters
+            shelf = max(shelf, h)
+
+        size = (max((rect.right for rect in self.rects), default=1), max((rect.bottom for rect in self.rects), default=1))
+        self.surface = pygame.Surface(size, pygame.SRCALPHA).convert_alpha()
+
+        for image, rect in zip(images, self.rects):
+            self.surface.blit(image, rect)  # Copied as is, the atlas starts fully transparent
+
+        self.surface = cache.optimize(self.surface)  # No RLE, an RLE surface is decoded again for every subsurface taken
+
+        self.mirror = None  # Same layout with frames flipped the first time they are asked for
+        self.flipped = set()
+        self.masks = {}
+
+    def __len__(self):
+        return len(self.rects)
+
+    def source(self, index, mirrored=False):
+        if not mirrored:
+            return self.surface
+
+        if self.mirror is None:
+            self.mirror = pygame.Surface(self.surface.get_size(), pygame.SRCALPHA).convert_alpha()
+
+        if index not in self.flipped:
+            rect = self.rects[index]
+            self.mirror.blit(pygame.transform.flip(self.surface.subsurface(rect), True, False), rect)
+            self.flipped.add(index)
+
+        return self.mirror
+
+    def trim(self):
+        self.mirror = None  # Flipped again the next time a mirrored frame is asked for
+        self.flipped.clear()
+        self.masks = {key: mask for key, mask in self.masks.items() if not key[1]}
+
+    def frame(self, index, mirrored=False):
+        return self.source(index, mirrored).subsurface(self.rects[index])
+
+    def mask(self, index, mirrored=False):
+        key = (index, mirrored)
+
+        if key not in self.masks:
+            self.masks[key] = pygame.mask.from_surface(self.frame(index, mirrored))
+
+        return self.masks[key]
+
+    def blit_args(self, index, pos, mirrored=False):
+        return self.source(index, mirrored), pos, self.rects[index]  # For Surface.blit and Surface.blits
 
 
 class SpriteGroup:
-    def __init__(self, path, name, dt, size=None, start_group=None, mirror=True):
+    # Frame data only, shared by every Animation that plays it
+    def __init__(self, path, name, dt, size=None, mirror=True, lazy=False, cache_size=4, prefetch=2, collide=True, clip=None):
         self.name = name
 
         self.dt = dt
-        self.time = 0
-        self.index = 0
-        self.group = start_group
-
-        self.rules = []
-        self.mirror_func = lambda: False
         self.mirror = mirror
 
-        self.sprites = {}
+        self.size = size
+        self.clip = clip  # Frames drawn at (0, 0) larger than the screen only keep the part that is ever visible
+        self.lazy = lazy
+        self.collide = collide
+
+        self.files = {}
 
         for file in glob.glob(os.path.join(path, name) + "*.png"):
             file_name = os.path.splitext(os.path.split(file)[1])[0]
             _, group, index = file_name.split("_")
             index = int(index)
 
-            if group not in self.sprites:
-                self.sprites[group] = []
-                if self.mirror: self.sprites[f"{group}-mirror"] = []
+            if group not in self.files:
+                self.files[group] = []
 
-            if len(self.sprites[group]) - 1 < index:
-                self.sprites[group].extend([None] * (index - len(self.sprites[group]) + 1))
-                if self.mirror: self.sprites[f"{group}-mirror"].extend([None] * (index - len(self.sprites[f"{group}-mirror"]) + 1))
+            if len(self.files[group]) - 1 < index:
+                self.files[group].extend([None] * (index - len(self.files[group]) + 1))
 
-            img = pygame.image.load(file).convert_alpha()
+            self.files[group][index] = file
 
-            if size:
-                img = pygame.transform.scale(img, size)
+        self.atlas = None
+        self.slots = {}
 
-            self.sprites[group][index] = img
-            if self.mirror: self.sprites[f"{group}-mirror"][index] = pygame.transform.flip(img, True, False)
+        # Lazy groups only keep a bounded LRU of decoded frames keyed by (group, index, mirrored)
+        self.frames = OrderedDict()
+        self.cache_size = max(cache_size, prefetch + 1)
+        self.prefetch = prefetch
+        self.pending = {}
+        self.executor = None
 
-        self.masks = {}
+        if self.lazy:
+            return
+
+        images = []
+
+        for group, files in self.files.items():
+            self.slots[group] = list(range(len(images), len(images) + len(files)))
+            images.extend(cache.load_image(file, self.size, clip=self.clip) for file in files)
+
+        self.atlas = Atlas(images)  # One surface for every frame, mirrored ones are made on demand
+
+    def load_frame(self, group, index, mirrored):
+        file = self.files[group][index]
+
+        img = cache.load_image(file, self.size, mirrored, self.clip)
+        mask = cache.load_mask(file, self.size, mirrored, clip=self.clip) if self.collide else None
+
+        return img, mask
+
+    def get_frame(self, group, index, mirrored):
+        if not self.lazy:
+            slot = self.slots[group][index]
+            return self.atlas.frame(slot, mirrored), self.atlas.mask(slot, mirrored) if self.collide else None
+
+        key = (group, index, mirrored)
+
+        if key in self.frames:
+            self.frames.move_to_end(key)
+            return self.frames[key]
+
+        if key in self.pending:
+            frame = self.pending.pop(key).result()  # Only blocks if the prefetch hasn't finished yet
+        else:
+            frame = self.load_frame(group, index, mirrored)
+
+        self.frames[key] = frame
+
+        if len(self.frames) > self.cache_size:
+            self.frames.popitem(last=False)  # Drop the least recently used frame
+
+        return frame
+
+    def trim(self):
+        self.frames.clear()  # Playing animations reload their current frame on the next get_frame
+
+        for future in self.pending.values():
+            future.cancel()  # One already decoding finishes on the worker and is dropped
+
+        self.pending.clear()
+
+        if self.atlas is not None:
+            self.atlas.trim()
+
+    def draw(self, screen, pos, group, index, mirrored):
+        if self.lazy:
+            return screen.blit(self.get_frame(group, index, mirrored)[0], pos)
+
+        return screen.blit(*self.atlas.blit_args(self.slots[group][index], pos, mirrored))
+
+    def prefetch_frames(self, group, index, mirrored):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+
+        count = len(self.files[group])
+
+        for step in range(1, self.prefetch + 1):
+            key = (group, (index + step) % count, mirrored)
+
+            if key not in self.frames and key not in self.pending:
+                self.pending[key] = self.executor.submit(self.load_frame, *key)  # Decode and scale off the main thread
 
-        for group, imgs in self.sprites.items():
-            self.masks[group] = []
 
-            for img in imgs:
-                self.masks[group].append(pygame.mask.from_surface(img))
+class Animation:
+    # Playback position of one entity, the frames themselves stay in the shared SpriteGroup
+    def __init__(self, frames, group):
+        self.frames = frames
+
+        self.group = group
+        self.next_group = group
+        self.count = len(frames.files[group])
+
+        self.time = 0
+        self.index = 0
+        self.mirrored = False
+
+    def snapshot(self):
+        return self.group, self.next_group, self.index, self.time, self.mirrored
+
+    def restore(self, snapshot):
+        self.group, self.next_group, self.index, self.time, self.mirrored = snapshot
+        self.count = len(self.frames.files[self.group])
+
+    def play(self, group):
+        self.next_group = group  # Switched on the next tick, so flip-flopping in between doesn't restart it
+
+    def face(self, left):
+        self.mirrored = self.frames.mirror and left
+
+    def tick(self, dt):
+        if self.next_group != self.group:
+            self.group = self.next_group
+            self.count = len(self.frames.files[self.group])
+            self.time = 0
+            self.index = 0
+
+        self.time += dt
+
+        if self.time > self.frames.dt:
+            self.index = (self.index + 1) % self.count
+            self.time %= self.frames.dt
+
+        if self.frames.lazy:
+            self.frames.prefetch_frames(self.group, self.index, self.mirrored)
 
     @property
     def sprite(self):
-        if self.mirror:
-            return self.sprites[self.group][self.index] if not self.mirror_func() else self.sprites[f"{self.group}-mirror"][self.index]
-        else:
-            return self.sprites[self.group][self.index]
+        return self.frames.get_frame(self.group, self.index, self.mirrored)[0]
 
     @property
     def mask(self):
-        if self.mirror:
-            return self.masks[self.group][self.index] if not self.mirror_func() else self.masks[f"{self.group}-mirror"][self.index]
-        else:
-            return self.masks[self.group][self.index]
+        return self.frames.get_frame(self.group, self.index, self.mirrored)[1]
 
-    def add_rule(self, eval_func, group):
-        self.rules.append((eval_func, group))
+    def draw(self, screen, pos):
+        return self.frames.draw(screen, pos, self.group, self.index, self.mirrored)
 
-    def set_mirror(self, eval_func):
-        self.mirror_func = eval_func
 
-    def tick(self, dt):
-        for eval_func, group in self.rules:
-            if eval_func():
-                if group != self.group:
-                    self.group = group
-                    self.time = 0
-                    self.index = 0
+def mask_runs(data, start, stop, step):
+    starts = array("H")
+    ends = array("H")
 
-                break
+    for run in re.finditer(b"\xff+", data[start:stop:step]):
+        starts.append(run.start())
+        ends.append(run.end())
 
-        self.time += dt
+    return starts, ends
+
+
+def clearance(lines, first, last, near, far, direction):
+    # Smallest push along the line axis that moves [near, far) clear of every solid run on lines [first, last)
+    intervals = []
+
+    for line in range(max(first, 0), min(last, len(lines))):
+        for start, end in zip(*lines[line]):
+            if direction > 0:
+                low, high = start - far + 1, end - near - 1
+            else:
+                low, high = near - end + 1, far - start - 1
+
+            if high >= 0:
+                intervals.append((low, high))
+
+    shift = 0
+
+    for low, high in sorted(intervals):
+        if low > shift:
+            break
+
+        shift = max(shift, high + 1)
+
+    return shift * direction
+
+
+def sweep(lines, first, last, near, far, distance):
+    # Furthest move towards distance along the line axis before [near, far) touches a solid run
+    if distance > 0:
+        for starts, ends in lines[max(first, 0):max(last, 0)]:
+            index = bisect_right(ends, near)  # Nearest run that isn't entirely behind us
+
+            if index < len(starts) and starts[index] - far < distance:
+                distance = max(starts[index] - far, 0)
+
+    elif distance < 0:
+        for starts, ends in lines[max(first, 0):max(last, 0)]:
+            index = bisect_left(starts, far) - 1
+
+            if index >= 0 and ends[index] - near > distance:
+                distance = min(ends[index] - near, 0)
+
+    return distance
+
+
+class RunTable:
+    def __init__(self, mask):
+        w, h = mask.get_size()
+        data = cache.mask_to_bytes(mask)
+
+        self.rows = [mask_runs(data, y * w, (y + 1) * w, 1) for y in range(h)]  # Solid [start, end) spans along x
+        self.cols = [mask_runs(data, x, None, w) for x in range(w)]  # Solid [start, end) spans along y
+
+    def to_bytes(self):
+        lines = self.rows + self.cols
+        counts = array("H", [len(starts) for starts, _ in lines])
+
+        return b"".join([counts.tobytes()] + [starts.tobytes() + ends.tobytes() for starts, ends in lines])
+
+    @classmethod
+    def from_bytes(cls, data, size):
+        w, h = size
+        flat = array("H")
+        flat.frombytes(data)
+
+        lines = []
+        offset = w + h  # Run count of every row then every column, then each line's starts and ends
+
+        for count in flat[:w + h]:
+            lines.append((flat[offset:offset + count], flat[offset + count:offset + 2 * count]))
+            offset += 2 * count
+
+        table = cls.__new__(cls)
+        table.rows, table.cols = lines[:h], lines[h:]
+
+        return table
+
+    @classmethod
+    def stack(cls, tables, height):
+        # Bands of the same height, top to bottom, as one table, column spans meeting at a seam are joined
+        table = cls.__new__(cls)
+        table.rows = [row for band in tables for row in band.rows]
+        table.cols = []
+
+        for columns in zip(*(band.cols for band in tables)):
+            starts = array("H")
+            ends = array("H")
+
+            for offset, (band_starts, band_ends) in zip(range(0, len(tables) * height, height), columns):
+                for start, end in zip(band_starts, band_ends):
+                    if ends and ends[-1] == start + offset:
+                        ends[-1] = end + offset
+                    else:
+                        starts.append(start + offset)
+                        ends.append(end + offset)
+
+            table.cols.append((starts, ends))
+
+        return table
+
+    def resolve(self, rect, dx, dy):
+        if dy:
+            return clearance(self.cols, rect.left, rect.right, rect.top, rect.bottom, dy)
+
+        return clearance(self.rows, rect.top, rect.bottom, rect.left, rect.right, dx)
+
+    def sweep(self, rect, dx, dy):
+        if dy:
+            return sweep(self.cols, rect.left, rect.right, rect.top, rect.bottom, dy)
 
-        if self.time > self.dt:
-            self.index = (self.index + 1) % len(self.sprites[self.group])
-            self.time %= self.dt
+        return sweep(self.rows, rect.top, rect.bottom, rect.left, rect.right, dx)